@@ -0,0 +1,266 @@
+'''
+@author: Antonin Duroy
+
+Benchmarks of the parsing, generation and similarity hot paths
+
+    python benchmarks/bench.py                      # run everything
+    python benchmarks/bench.py --quick -k unspin    # smallest sizes, names containing unspin
+    python benchmarks/bench.py -o results.json      # save the results as JSON
+    python benchmarks/bench.py --baseline results.json --tolerance 0.2
+
+With --baseline, the timings are compared with the ones of a previous run and
+the exit code is 1 if any of them is slower by more than the tolerance
+'''
+
+import os
+import sys
+import json
+import atexit
+import shutil
+import platform
+import tempfile
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import numpy as np
+import text_similarity as ts
+
+from spin import Spin
+from generators import (nested_masterspin, wide_masterspin, article_masterspin,
+                        masterspin_file, documents)
+
+BENCHMARKS = []
+
+def benchmark(name, sizes):
+    """ Register setup(size), returning the function to time, for every size
+    (the first one being the only size of a quick run)
+    """
+    def register(setup):
+        for size in sizes:
+            BENCHMARKS.append((name, size, setup))
+        return setup
+    return register
+
+MASTERSPINS = {
+    'nested-50': lambda: nested_masterspin(50),
+    'nested-500': lambda: nested_masterspin(500),
+    'wide-100x5': lambda: wide_masterspin(100, 5),
+    'wide-1000x50': lambda: wide_masterspin(1000, 50),
+    'article-10': lambda: article_masterspin(10),
+    'article-200': lambda: article_masterspin(200),
+}
+
+###############################################################################
+# PARSING AND GENERATION
+###############################################################################
+@benchmark('Spin.unspin', list(MASTERSPINS))
+def bench_unspin(size):
+    spin = Spin(MASTERSPINS[size]())
+    spin.compile()
+    return spin.unspin
+
+@benchmark('Spin.compile', list(MASTERSPINS))
+def bench_compile(size):
+    masterspin = MASTERSPINS[size]()
+    return lambda: Spin(masterspin).compile()
+
+@benchmark('Spin.unspin_many', ['article-10', 'wide-1000x50'])
+def bench_unspin_many(size):
+    spin = Spin(MASTERSPINS[size]())
+    spin.compile()
+    return lambda: spin.unspin_many(1000, seed=0)
+
+@benchmark('Spin.build_tree', list(MASTERSPINS))
+def bench_build_tree(size):
+    masterspin = MASTERSPINS[size]()
+    return lambda: Spin(masterspin).build_tree()
+
+@benchmark('SpinTree.to_json', list(MASTERSPINS))
+def bench_to_json(size):
+    return Spin(MASTERSPINS[size]()).build_tree().to_json
+
+@benchmark('Spin.iter_file', [1 << 20, 8 << 20])
+def bench_iter_file(size):
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    path = os.path.join(directory, 'masterspins.txt')
+    masterspin_file(path, size)
+    return lambda: sum(1 for _ in Spin.iter_file(path))
+
+###############################################################################
+# TEXT SIMILARITY
+###############################################################################
+def pair(length):
+    doc1, doc2 = documents(2, length)
+    return doc1.split(), doc2.split()
+
+def interned_pair(length):
+    ids, _ = ts.intern_tokens(pair(length))
+    return ids
+
+@benchmark('jaccard_similarity', [100, 10000])
+def bench_jaccard(size):
+    seq1, seq2 = pair(size)
+    return lambda: ts.jaccard_similarity(seq1, seq2)
+
+@benchmark('jaro_winkler_similarity', [100, 10000])
+def bench_jaro_winkler(size):
+    seq1, seq2 = interned_pair(size)
+    return lambda: ts.jaro_winkler_similarity(seq1, seq2)
+
+@benchmark('jaro_winkler_many', [100, 1000])
+def bench_jaro_winkler_many(size):
+    ids, _ = ts.intern_tokens(doc.split() for doc in documents(size, 100))
+    return lambda: ts.jaro_winkler_many(ids[0], ids)
+
+@benchmark('cosine_similarity', [100, 10000])
+def bench_cosine(size):
+    seq1, seq2 = pair(size)
+    return lambda: ts.cosine_similarity(seq1, seq2)
+
+@benchmark('hamming_distance', [100, 10000])
+def bench_hamming(size):
+    seq1, seq2 = pair(size)
+    return lambda: ts.hamming_distance(seq1, seq2)
+
+@benchmark('levenshtein_distance', [100, 10000])
+def bench_levenshtein(size):
+    seq1, seq2 = interned_pair(size)
+    return lambda: ts.levenshtein_distance(seq1, seq2)
+
+@benchmark('levenshtein_similarity(threshold=0.9)', [100, 10000])
+def bench_levenshtein_threshold(size):
+    seq1, seq2 = interned_pair(size)
+    return lambda: ts.levenshtein_similarity(seq1, seq2, threshold=0.9)
+
+@benchmark('minkowski_distance(p=3)', [100, 10000])
+def bench_minkowski(size):
+    seq1, seq2 = pair(size)
+    return lambda: ts.minkowski_distance(seq1, seq2, 3)
+
+@benchmark('manhattan_distance', [100, 10000])
+def bench_manhattan(size):
+    seq1, seq2 = pair(size)
+    return lambda: ts.manhattan_distance(seq1, seq2)
+
+@benchmark('euclidean_distance', [100, 10000])
+def bench_euclidean(size):
+    seq1, seq2 = pair(size)
+    return lambda: ts.euclidean_distance(seq1, seq2)
+
+@benchmark('minkowski_distances(p=3)', [100, 500])
+def bench_minkowski_distances(size):
+    counts, _ = ts.count_matrix(doc.split() for doc in documents(size, 100))
+    return lambda: ts.minkowski_distances(counts, p=3)
+
+@benchmark('euclidean_distances', [100, 2000])
+def bench_euclidean_distances(size):
+    counts, _ = ts.count_matrix(doc.split() for doc in documents(size, 100))
+    return lambda: ts.euclidean_distances(counts)
+
+@benchmark('count_matrix', [100, 10000])
+def bench_count_matrix(size):
+    seqs = [doc.split() for doc in documents(size, 100)]
+    return lambda: ts.count_matrix(seqs)
+
+@benchmark('similarity_matrix(jaccard)', [100, 2000])
+def bench_similarity_matrix(size):
+    docs = documents(size, 100)
+    return lambda: ts.similarity_matrix(docs, 'jaccard')
+
+@benchmark('similarity_matrix(cosine)', [100, 2000])
+def bench_similarity_matrix_cosine(size):
+    docs = documents(size, 100)
+    return lambda: ts.similarity_matrix(docs, 'cosine')
+
+@benchmark('max_previous_similarity', [100, 2000])
+def bench_max_previous_similarity(size):
+    matrix = np.random.default_rng(0).random((size, size))
+    return lambda: ts.max_previous_similarity(matrix)
+
+@benchmark('SimilarityIndex.similarities', [100, 10000])
+def bench_similarity_index(size):
+    index = ts.SimilarityIndex('jaccard')
+    for doc in documents(size, 100):
+        index.add(doc.split())
+    tokens = documents(1, 100, seed=1)[0].split()
+    return lambda: index.similarities(tokens)
+
+###############################################################################
+# RUN AND COMPARE
+###############################################################################
+def key(result):
+    return '%s[%s]' % (result['name'], result['size'])
+
+def run(pattern=None, quick=False, repeat=5):
+    """ Time every registered benchmark (whose name contains pattern, if any)
+    and return the list of results, the time of a call being the best of
+    repeat measures
+    """
+    results = []
+    first_sizes = {}
+    for name, size, setup in BENCHMARKS:
+        first_sizes.setdefault(name, size)
+        if pattern is not None and pattern not in name:
+            continue
+        if quick and size != first_sizes[name]:
+            continue
+        timer = timeit.Timer(setup(size))
+        loops, _ = timer.autorange()
+        times = [elapsed / loops for elapsed in timer.repeat(repeat, loops)]
+        result = {'name': name, 'size': size, 'best': min(times),
+                  'mean': sum(times) / len(times), 'loops': loops}
+        print('%-45s %12.6f s' % (key(result), result['best']))
+        results.append(result)
+    return results
+
+def environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'processor': platform.processor()}
+
+def compare(results, baseline, tolerance):
+    """ Print the ratio of every timing to the baseline one and return the keys
+    of the benchmarks slower by more than tolerance (0.2 meaning 20%)
+    """
+    previous = {key(result): result['best'] for result in baseline['results']}
+    regressions = []
+    print('\n%-45s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for result in results:
+        if key(result) not in previous:
+            continue
+        ratio = result['best'] / previous[key(result)]
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(key(result))
+            flag = '  SLOWER'
+        print('%-45s %12.6f %12.6f %8.2f%s' % (key(result), previous[key(result)],
+                                               result['best'], ratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the spin framework hot paths')
+    parser.add_argument('-k', dest='pattern', help='only run the benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true', help='only run the smallest size of every benchmark')
+    parser.add_argument('--repeat', type=int, default=5, help='number of measures of every benchmark')
+    parser.add_argument('-o', '--output', help='JSON file to write the results to')
+    parser.add_argument('--baseline', help='JSON file of previous results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown ratio above which a benchmark is a regression')
+    args = parser.parse_args(argv)
+
+    results = run(args.pattern, args.quick, args.repeat)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print('\n%d regression(s): %s' % (len(regressions), ', '.join(regressions)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+'''
+@author: Antonin Duroy
+'''
+
+import random
+
+WORDS = ('the', 'spin', 'framework', 'article', 'content', 'writer', 'text', 'great',
+         'quick', 'simple', 'really', 'love', 'make', 'build', 'many', 'unique',
+         'page', 'search', 'engine', 'duplicate', 'words', 'every', 'new', 'one')
+
+def words(rand, n):
+    return ' '.join(rand.choice(WORDS) for _ in range(n))
+
+def nested_masterspin(depth, width=2, seed=0):
+    """ Masterspin of OR groups nested depth levels deep, every group having
+    width branches, the first of which holds the next level
+    """
+    rand = random.Random(seed)
+    masterspin = words(rand, 3)
+    for _ in range(depth):
+        branches = [masterspin] + [words(rand, 3) for _ in range(width - 1)]
+        masterspin = '%s {%s} %s' % (words(rand, 2), '|'.join(branches), words(rand, 2))
+    return masterspin
+
+def wide_masterspin(groups, width, seed=0):
+    """ Masterspin of groups OR groups of width one or two word branches,
+    separated by literal text
+    """
+    rand = random.Random(seed)
+    return ' '.join('%s {%s}' % (words(rand, 4), '|'.join(words(rand, rand.randint(1, 2))
+                                                          for _ in range(width)))
+                    for _ in range(groups))
+
+def article_masterspin(paragraphs, seed=0):
+    """ Article-like masterspin: paragraphs of sentences mixing plain text, flat
+    groups and groups nested two levels deep
+    """
+    rand = random.Random(seed)
+    sentences = []
+    for _ in range(paragraphs * 5):
+        sentences.append('{%s|%s|%s {%s|{%s|%s}}} %s {%s|%s}.' % (
+            words(rand, 3), words(rand, 3), words(rand, 2), words(rand, 2),
+            words(rand, 1), words(rand, 2), words(rand, 8), words(rand, 2), words(rand, 3)))
+    return '\n'.join(' '.join(sentences[i:i+5]) for i in range(0, len(sentences), 5))
+
+def masterspin_file(path, size, separator='\n', seed=0):
+    """ Write masterspins separated by separator to path, up to about size bytes,
+    and return the number of masterspins written
+    """
+    count = 0
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < size:
+            masterspin = article_masterspin(2, seed + count).replace('\n', ' ')
+            f.write(masterspin + separator)
+            written += len(masterspin) + len(separator)
+            count += 1
+    return count
+
+def documents(n, length, seed=0):
+    """ n documents of length words, as strings
+    """
+    rand = random.Random(seed)
+    return [words(rand, length) for _ in range(n)]
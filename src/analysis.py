@@ -0,0 +1,111 @@
+'''
+@author: Antonin Duroy
+'''
+
+from tree import OR
+
+def diversity_report(tree, n=None):
+    """ Closed-form estimates of the diversity of the spuns of a tree, for spuns
+    drawn as by Spin.unspin() (every OR node picking a branch uniformly):
+        count: number of combinations of choices
+        expected_tokens: expected number of tokens of a spun
+        expected_jaccard: expected Jaccard similarity of the sets of tokens of two
+            spuns, approximated by E[|A & B|] / E[|A | B|]
+        collision_probability: probability that two spuns make the same choices
+        expected_collisions, birthday_collisions: expected number of pairs of
+            identical spuns among n ones, exactly and as if the combinations were
+            drawn uniformly (only if n is given)
+        or_nodes: for every OR node, in order of appearance, its number of
+            branches, the probability to reach it, the expected number of tokens
+            of its branches and its contribution to diversity, the expected
+            number of tokens by which it makes two spuns differ
+    Tokens are taken from each literal separately (split on whitespaces), so a
+    word spread over several literals counts as several tokens. The tree is
+    traversed twice, without recursion
+    """
+    # Depth-first order, with the probability to reach every node
+    nodes = []
+    stack = [(tree, 1.0)]
+    while stack:
+        node, reach = stack.pop()
+        nodes.append((node, reach))
+        share = reach / len(node.children) if node.kind == OR else reach
+        stack.extend((child, share) for child in reversed(node.children))
+
+    # Bottom-up: probability of every token to appear, expected number of tokens
+    # and probability that two independent draws make the same choices. The
+    # presences of a node are the ones of its largest child updated in place
+    # (the others being merged into them), so that a deep tree is not copied
+    # at every level. They are stored as (dict, scale), the actual presence of
+    # a token being scale * dict[token], so that an OR node scales them in O(1)
+    presence = {}
+    length = {}
+    same = {}
+    for node, _ in reversed(nodes):
+        tokens = node.value.split() if node.value is not None else []
+        children = node.children
+        merged = [presence.pop(id(child)) for child in children]
+        if merged:
+            node_presence, scale = merged.pop(max(range(len(merged)), key=lambda i: len(merged[i][0])))
+        else:
+            node_presence, scale = {}, 1.0
+        node_length = float(len(tokens))
+        node_same = 1.0
+        if node.kind == OR:
+            k = len(children)
+            scale /= k
+            for child_presence, child_scale in merged:
+                factor = child_scale / (k * scale)
+                for token, p in child_presence.items():
+                    node_presence[token] = node_presence.get(token, 0.0) + p * factor
+            for token in set(tokens):
+                node_presence[token] = node_presence.get(token, 0.0) + 1.0 / scale
+            node_length += sum(length[id(child)] for child in children) / k
+            node_same = sum(same[id(child)] for child in children) / (k * k)
+        else:
+            for child_presence, child_scale in merged:
+                for token, p in child_presence.items():
+                    q = node_presence.get(token, 0.0) * scale
+                    node_presence[token] = (1 - (1 - q) * (1 - p * child_scale)) / scale
+            for token in tokens:
+                node_presence[token] = 1.0 / scale
+            for child in children:
+                node_length += length[id(child)]
+                node_same *= same[id(child)]
+        if scale < 1e-100:
+            for token in node_presence:
+                node_presence[token] *= scale
+            scale = 1.0
+        presence[id(node)] = (node_presence, scale)
+        length[id(node)] = node_length
+        same[id(node)] = node_same
+
+    node_presence, scale = presence[id(tree)]
+    token_presence = [scale * q for q in node_presence.values()]
+    intersection = sum(q * q for q in token_presence)
+    union = sum(2 * q - q * q for q in token_presence)
+    report = {
+        'count': tree.count(),
+        'expected_tokens': length[id(tree)],
+        'expected_jaccard': intersection / union if union else 1.0,
+        'collision_probability': same[id(tree)],
+        'or_nodes': [],
+    }
+    if n is not None:
+        pairs = n * (n - 1) / 2
+        report['expected_collisions'] = pairs * same[id(tree)]
+        report['birthday_collisions'] = pairs / report['count']
+
+    for node, reach in nodes:
+        if node.kind != OR:
+            continue
+        k = len(node.children)
+        branch_length = sum(length[id(child)] for child in node.children) / k
+        report['or_nodes'].append({
+            'index': len(report['or_nodes']),
+            'branches': k,
+            'reach': reach,
+            'expected_tokens': branch_length,
+            'contribution': reach * reach * (1 - 1 / k) * branch_length,
+        })
+    return report
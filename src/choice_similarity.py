@@ -0,0 +1,103 @@
+'''
+@author: Antonin Duroy
+'''
+
+import metrics
+
+from collections import Counter
+from math import sqrt
+
+class ChoiceSimilarity():
+    """ Jaccard and cosine similarities of the spuns of a SpinProgram computed
+    from their choice vectors (see SpinProgram.trace()) instead of their text
+
+    The tokens of every spun are the ones of the top level literals plus, for
+    every choice node visited, the ones of the literals directly in the branch
+    taken. Two spuns only differ by the branches of the nodes where their
+    choices differ, so once every spun has a profile (built once, in the time
+    of its text), a pair is compared in O(number of choice nodes + tokens of the
+    differing branches) instead of O(length of the spuns)
+
+    Tokens are taken from each literal separately (split on whitespaces), so
+    the similarities are the ones of the texts as long as the braces of the
+    masterspin sit between words
+    """
+
+    def __init__(self, program):
+        self.program = program
+        self.base = self.__tokens(0, len(program.ops))
+        self.deltas = [[tuple(self.__tokens(start, stop).items()) for start, stop in branches]
+                       for branches, _ in program.choices]
+
+    def __tokens(self, start, stop):
+        """ Token counts of the literals in ops[start:stop], nested choice nodes
+        excluded
+        """
+        ops = self.program.ops
+        choices = self.program.choices
+        counts = Counter()
+        pc = start
+        while pc < stop:
+            op = ops[pc]
+            if op.__class__ is str:
+                counts.update(op.split())
+                pc += 1
+            else:
+                pc = choices[op][1]
+        return counts
+
+    def profile(self, choices):
+        """ Profile of the spun made from choices (a draw or a choice vector):
+        its choice vector, its token counts, their number of distinct tokens and
+        their squared norm
+        """
+        vector = self.program.trace(choices)
+        counts = Counter(self.base)
+        for k, branch in enumerate(vector):
+            if branch >= 0:
+                for token, count in self.deltas[k][branch]:
+                    counts[token] += count
+        return (vector, counts, len(counts),
+                sum(count * count for count in counts.values()))
+
+    def __difference(self, profile1, profile2):
+        """ Token counts of the first spun minus the ones of the second
+        """
+        difference = {}
+        get = difference.get
+        deltas = self.deltas
+        for k, (branch1, branch2) in enumerate(zip(profile1[0], profile2[0])):
+            if branch1 != branch2:
+                if branch1 >= 0:
+                    for token, count in deltas[k][branch1]:
+                        difference[token] = get(token, 0) + count
+                if branch2 >= 0:
+                    for token, count in deltas[k][branch2]:
+                        difference[token] = get(token, 0) - count
+        return difference
+
+    @metrics.timed('choice_similarity.jaccard', 1)
+    def jaccard(self, profile1, profile2):
+        """ Jaccard similarity of the sets of tokens of two profiled spuns
+        """
+        counts2 = profile2[1]
+        added = 0
+        for token, delta in self.__difference(profile1, profile2).items():
+            if delta > 0 and counts2.get(token, 0) == 0:
+                added += 1
+        union = profile2[2] + added
+        if union == 0:
+            return 0.0
+        return (profile1[2] + profile2[2] - union) / union
+
+    @metrics.timed('choice_similarity.cosine', 1)
+    def cosine(self, profile1, profile2):
+        """ Cosine similarity of the token counts of two profiled spuns
+        """
+        counts2 = profile2[1]
+        dot = profile2[3] + sum(delta * counts2.get(token, 0)
+                                for token, delta in self.__difference(profile1, profile2).items())
+        norms = sqrt(profile1[3] * profile2[3])
+        if norms == 0:
+            return 0.0
+        return dot / norms
@@ -0,0 +1,157 @@
+'''
+@author: Antonin Duroy
+'''
+
+import os
+import json
+import numpy as np
+
+from text_similarity import SimilarityIndex, intern_tokens, jaro_winkler_many
+
+METRICS = ('jaccard', 'jaro_winkler', 'cosine')
+
+# Files of a checkpoint directory
+_STATE = 'state.json'
+_SPUNS = 'spuns.jsonl'
+_CURVES_CSV = 'curves.csv'
+_CURVES_NPY = 'curves.npy'
+
+class DuplicateEvaluator():
+    """ Running duplicate evolution of a stream of spuns: for every metric, the
+    curve of the highest similarity between every spun and the ones before it
+    (0 for the first one), as plotted by Spin.plot_duplicate_evolution()
+
+    Every spun is tokenized and interned once. Jaccard and cosine similarities
+    go through an inverted index, while Jaro-Winkler compares the new spun with
+    every previous one (quadratic in the number of spuns overall, so better left
+    out of long evaluations)
+    """
+
+    def __init__(self, metrics=('jaccard', 'cosine')):
+        for metric in metrics:
+            if metric not in METRICS:
+                raise ValueError('Unknown metric: %s' % metric)
+        self.metrics = tuple(metrics)
+        self.indexes = {metric: SimilarityIndex(metric)
+                        for metric in self.metrics if metric != 'jaro_winkler'}
+        self.vocabulary = {}
+        self.tokens = []  # interned tokens of every spun, for Jaro-Winkler
+        self.curves = {metric: [] for metric in self.metrics}
+        self.rng_state = None
+
+    def __len__(self):
+        return len(self.curves[self.metrics[0]]) if self.metrics else 0
+
+    def add(self, spun):
+        """ Compare a new spun with the previous ones, extend the curves and
+        return the highest similarity for every metric
+        """
+        tokens = spun.split()
+        similarities = {}
+        for metric in self.metrics:
+            if metric == 'jaro_winkler':
+                interned = intern_tokens([tokens], self.vocabulary)[0][0]
+                similarities[metric] = (jaro_winkler_many(interned, self.tokens).max()
+                                        if self.tokens else 0.0)
+                self.tokens.append(interned)
+            else:
+                similarities[metric] = self.indexes[metric].max_similarity(tokens)
+                self.indexes[metric].add(tokens)
+            self.curves[metric].append(float(similarities[metric]))
+        return similarities
+
+    def update(self, spuns):
+        for spun in spuns:
+            self.add(spun)
+
+    def curve_array(self):
+        """ (number of spuns x number of metrics) array of the curves
+        """
+        return np.array([self.curves[metric] for metric in self.metrics]).T.reshape(-1, len(self.metrics))
+
+    def save_curves(self, directory):
+        """ Write the curves to curves.csv and curves.npy in directory
+        """
+        curves = self.curve_array()
+        path = os.path.join(directory, _CURVES_NPY)
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, curves)
+        os.replace(path + '.tmp', path)
+        path = os.path.join(directory, _CURVES_CSV)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(','.join(('spun',) + self.metrics) + '\n')
+            for i, row in enumerate(curves.tolist()):
+                f.write('%d,%s\n' % (i, ','.join('%.6f' % value for value in row)))
+        os.replace(path + '.tmp', path)
+
+    def checkpoint(self, directory, spuns):
+        """ Save the state of the evaluation to directory: spuns (the ones added
+        since the last checkpoint) are appended to spuns.jsonl, then the curves
+        and the state (number of spuns, metrics, random state) are rewritten.
+        At the first checkpoint (spuns being all the spuns of the evaluation),
+        spuns.jsonl is rewritten instead, dropping the spuns of any previous
+        evaluation left in directory without a state
+        """
+        mode = 'a' if len(self) > len(spuns) else 'w'
+        with open(os.path.join(directory, _SPUNS), mode, encoding='utf-8') as f:
+            for spun in spuns:
+                f.write(json.dumps(spun) + '\n')
+        self.save_curves(directory)
+        state = {'count': len(self), 'metrics': self.metrics, 'rng': self.rng_state}
+        path = os.path.join(directory, _STATE)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def resume(cls, directory):
+        """ Rebuild an evaluator from the last checkpoint saved in directory, or
+        return None if there is none. The spuns are indexed again, but not
+        compared, their curves being read back
+        """
+        path = os.path.join(directory, _STATE)
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            state = json.load(f)
+        evaluator = cls(state['metrics'])
+        evaluator.rng_state = state['rng']
+        count = state['count']
+        curves = np.load(os.path.join(directory, _CURVES_NPY))[:count]
+        for metric, curve in zip(evaluator.metrics, curves.T.tolist()):
+            evaluator.curves[metric] = curve
+        spuns_path = os.path.join(directory, _SPUNS)
+        with open(spuns_path, 'r+', encoding='utf-8') as f:
+            for _ in range(count):
+                tokens = json.loads(f.readline()).split()
+                for index in evaluator.indexes.values():
+                    index.add(tokens)
+                if 'jaro_winkler' in evaluator.metrics:
+                    evaluator.tokens.append(intern_tokens([tokens], evaluator.vocabulary)[0][0])
+            # Drop the spuns written after the checkpoint by an interrupted run
+            f.truncate(f.tell())
+        return evaluator
+
+def plot_curves(curves, save_file=None):
+    """ Plot the sorted curves (metric -> list of similarities) one below the
+    other, and show them or save them to save_file. Saving does not need a
+    display, the figure being drawn without pyplot
+    """
+    if save_file is not None:
+        from matplotlib.figure import Figure
+        figure = Figure()
+    else:
+        import matplotlib.pyplot as plt
+        figure = plt.figure()
+    titles = {'jaccard': 'Jaccard', 'jaro_winkler': 'Jaro Winkler', 'cosine': 'Cosine'}
+    for position, (metric, curve) in enumerate(curves.items()):
+        axes = figure.add_subplot(len(curves), 1, position + 1)
+        axes.bar(range(len(curve)), sorted(curve))
+        axes.grid(True)
+        axes.set_title(titles.get(metric, metric))
+        x1, x2, y1, y2 = axes.axis()
+        axes.axis((x1, x2, y1, 1))
+    if save_file is not None:
+        figure.savefig(save_file)
+    else:
+        plt.show()
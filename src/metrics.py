@@ -0,0 +1,217 @@
+'''
+@author: Antonin Duroy
+'''
+
+import os
+import re
+import sys
+import cProfile
+import pstats
+import threading
+
+from bisect import bisect_left
+from contextlib import ContextDecorator
+from functools import wraps
+from time import perf_counter
+
+# Upper bounds of the buckets of the latency (in seconds) and size histograms
+LATENCY_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1, 5, 10)
+SIZE_BUCKETS = tuple(4 ** i for i in range(13))
+
+# Metrics are only recorded once enabled (or if the SPIN_METRICS environment
+# variable is set). Until then, an instrumented call only costs a check of
+# _enabled
+_enabled = bool(os.environ.get('SPIN_METRICS'))
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_hooks = []
+_active_hooks = 0
+_enabled_by_hooks = False  # Metrics were enabled by the first active hook
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    """ Forget every recorded metric
+    """
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+class Histogram():
+    """ Count of observed values per bucket, along with their number and sum
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+def count(name, value=1):
+    """ Add value to the counter name (if metrics are enabled)
+    """
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + value
+
+def observe(name, value, buckets=SIZE_BUCKETS):
+    """ Record value in the histogram name (if metrics are enabled)
+    """
+    if _enabled:
+        with _lock:
+            histogram = _histograms.get(name)
+            if histogram is None:
+                histogram = _histograms[name] = Histogram(buckets)
+            histogram.observe(value)
+
+def _record(name, elapsed):
+    observe(name + '.seconds', elapsed, LATENCY_BUCKETS)
+    for hook in _hooks:
+        hook(name, elapsed)
+
+class timer():
+    """ Context manager recording the time spent in a block in the histogram
+    name + '.seconds', and passing it to the hooks
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter() if _enabled else None
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start is not None:
+            _record(self.name, perf_counter() - self.start)
+        return False
+
+def timed(name, comparisons=None, result=None):
+    """ Decorator timing every call of a function as timer() does, once metrics
+    are enabled. comparisons is the number of similarity comparisons made by a
+    call, either a number or a function of the arguments of the call, added to
+    the counter 'similarity.comparisons'. result, if given, is called with the
+    value returned by every call, to record metrics about it
+    """
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = perf_counter()
+            value = function(*args, **kwargs)
+            _record(name, perf_counter() - start)
+            if comparisons is not None:
+                count('similarity.comparisons',
+                      comparisons(*args, **kwargs) if callable(comparisons) else comparisons)
+            if result is not None:
+                result(value)
+            return value
+        return wrapper
+    return decorate
+
+class hook(ContextDecorator):
+    """ Call callback(name, seconds) for every timed call made in a block (or
+    in a decorated function), metrics being enabled as long as a hook is active
+    """
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def __enter__(self):
+        global _active_hooks, _enabled_by_hooks
+        with _lock:
+            if _active_hooks == 0:
+                _enabled_by_hooks = not _enabled
+            _active_hooks += 1
+            _hooks.append(self.callback)
+        enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active_hooks
+        with _lock:
+            _hooks.remove(self.callback)
+            _active_hooks -= 1
+            if _active_hooks == 0 and _enabled_by_hooks:
+                disable()
+        return False
+
+class profile(ContextDecorator):
+    """ Run a block (or a decorated function) under cProfile, then save the
+    statistics to path if given, or print the limit costliest functions
+    (sorted by sort) to stream (sys.stderr by default)
+    """
+
+    def __init__(self, path=None, sort='cumulative', limit=30, stream=None):
+        self.path = path
+        self.sort = sort
+        self.limit = limit
+        self.stream = stream
+
+    def __enter__(self):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+        if self.path is not None:
+            self.profiler.dump_stats(self.path)
+        else:
+            stats = pstats.Stats(self.profiler, stream=self.stream or sys.stderr)
+            stats.sort_stats(self.sort).print_stats(self.limit)
+        return False
+
+def snapshot():
+    """ Dict of the recorded metrics: {'counters': {name: value}, 'histograms':
+    {name: {'count', 'sum', 'buckets': {upper bound: cumulative count}}}}
+    """
+    with _lock:
+        return {'counters': dict(_counters),
+                'histograms': {name: histogram.to_dict() for name, histogram in _histograms.items()}}
+
+def _metric_name(name):
+    return 'spin_' + re.sub('[^a-zA-Z0-9_]', '_', name)
+
+def to_prometheus():
+    """ Recorded metrics in the Prometheus text exposition format
+    """
+    lines = []
+    data = snapshot()
+    for name, value in sorted(data['counters'].items()):
+        name = _metric_name(name) + '_total'
+        lines.append('# TYPE %s counter' % name)
+        lines.append('%s %s' % (name, value))
+    for name, histogram in sorted(data['histograms'].items()):
+        name = _metric_name(name)
+        lines.append('# TYPE %s histogram' % name)
+        for bound, cumulative in histogram['buckets'].items():
+            bound = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_bucket{le="%s"} %d' % (name, bound, cumulative))
+        lines.append('%s_sum %r' % (name, histogram['sum']))
+        lines.append('%s_count %d' % (name, histogram['count']))
+    return '\n'.join(lines) + '\n'
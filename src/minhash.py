@@ -0,0 +1,126 @@
+'''
+@author: Antonin Duroy
+'''
+
+import json
+import random
+import numpy as np
+import metrics
+
+from zlib import crc32
+from nltk.util import ngrams
+
+# Hashes are taken modulo a Mersenne prime small enough for a*x+b to fit in 64 bits
+_PRIME = (1 << 31) - 1
+
+def shingles(doc, n=3):
+    """ Set of the n-grams of tokens of a document (a string, split on
+    whitespaces, or a sequence of tokens). Documents shorter than n tokens
+    give a single shingle
+    """
+    tokens = doc.split() if isinstance(doc, str) else list(doc)
+    if len(tokens) < n:
+        return {tuple(tokens)} if tokens else set()
+    return set(ngrams(tokens, n))
+
+class MinHashLSH():
+    """ Near-duplicate index: every document is summarized by a MinHash
+    signature of its shingles, and signatures are split into bands stored in
+    hash tables (Locality Sensitive Hashing), so that looking for the documents
+    similar to a new one only compares it with the documents sharing a band
+    """
+
+    def __init__(self, num_perm=128, bands=32, ngram=3, seed=1):
+        if num_perm % bands != 0:
+            raise ValueError('num_perm must be a multiple of bands.')
+        if seed is None:
+            # Drawn once and kept, so that a saved index hashes as the original
+            seed = random.SystemRandom().getrandbits(32)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.ngram = ngram
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+        self.keys = []
+        self.signatures = []
+        self.buckets = [{} for _ in range(bands)]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def signature(self, doc):
+        """ MinHash signature of a document, one minimum per hash function
+        """
+        hashes = [crc32('\x1f'.join(shingle).encode('utf-8')) % _PRIME
+                  for shingle in shingles(doc, self.ngram)]
+        if not hashes:
+            return np.full(self.num_perm, _PRIME, dtype=np.uint64)
+        hashes = np.array(hashes, dtype=np.uint64)
+        values = (self.a[:, None] * hashes[None, :] + self.b[:, None]) % _PRIME
+        return values.min(axis=1)
+
+    def __bands(self, signature):
+        rows = self.num_perm // self.bands
+        for band in range(self.bands):
+            yield band, signature[band*rows:(band+1)*rows].tobytes()
+
+    def add(self, doc, key=None):
+        """ Index a document under key (its position in the index by default)
+        and return the key
+        """
+        return self.add_signature(self.signature(doc), key)
+
+    def add_signature(self, signature, key=None):
+        """ Index an already computed signature
+        """
+        position = len(self.keys)
+        if key is None:
+            key = position
+        self.keys.append(key)
+        self.signatures.append(signature)
+        for band, bucket in self.__bands(signature):
+            self.buckets[band].setdefault(bucket, []).append(position)
+        return key
+
+    @metrics.timed('minhash.query')
+    def query(self, doc, threshold=0.8):
+        """ Return the (key, estimated Jaccard similarity) pairs of the indexed
+        documents whose similarity with doc is at least threshold, most similar
+        first
+        """
+        signature = self.signature(doc)
+        candidates = set()
+        for band, bucket in self.__bands(signature):
+            candidates.update(self.buckets[band].get(bucket, ()))
+        metrics.count('similarity.comparisons', len(candidates))
+        results = []
+        for position in candidates:
+            similarity = float(np.mean(self.signatures[position] == signature))
+            if similarity >= threshold:
+                results.append((self.keys[position], similarity))
+        results.sort(key=lambda result: -result[1])
+        return results
+
+    def save(self, path):
+        """ Save the index to a file in the NumPy .npz format (at path exactly,
+        np.savez() adding no extension to an open file)
+        """
+        signatures = np.array(self.signatures, dtype=np.uint64).reshape(-1, self.num_perm)
+        with open(path, 'wb') as f:
+            np.savez(f,
+                     params=np.array([self.num_perm, self.bands, self.ngram, self.seed], dtype=np.int64),
+                     signatures=signatures,
+                     keys=np.array(json.dumps(self.keys)))
+
+    @classmethod
+    def load(cls, path):
+        """ Load an index saved by save()
+        """
+        with np.load(path) as data:
+            num_perm, bands, ngram, seed = (int(param) for param in data['params'])
+            index = cls(num_perm, bands, ngram, seed)
+            for key, signature in zip(json.loads(str(data['keys'])), data['signatures']):
+                index.add_signature(signature, key)
+        return index
@@ -0,0 +1,257 @@
+'''
+@author: Antonin Duroy
+'''
+
+import mmap
+import random
+import struct
+import numpy as np
+import metrics
+
+from spintax import tokenize, TEXT, OPEN, SEP, CLOSE
+from utils import pack_strings, unpack_strings
+
+# Binary format: header, then the int32 arrays of the ops (a literal being
+# stored as -1 - its index in the string table), of the (start, stop) of every
+# branch, of the index of the first branch of every choice node (plus the total)
+# and of the next op of every choice node, then the derived tables: the text of
+# every branch (its index in the string table, -1 for None) and the (choice
+# node, branch) parent of every choice node ((-1, -1) at the top level), and
+# finally the string table
+_MAGIC = b'SPPG'
+_VERSION = 2
+_HEADER = struct.Struct('<4sIIIIII')
+
+class SpinProgram():
+    """ Compiled, flat representation of a masterspin
+
+    ops is a flat list where a string is a literal segment and an integer k
+    refers to the k-th choice node (numbered in order of appearance).
+    choices[k] is a (branches, next) pair: branches lists the (start, stop)
+    ranges of ops making up every alternative, and next is the position of
+    the first op following the whole group.
+    """
+
+    def __init__(self, ops, choices, texts=None, parents=None):
+        self.ops = ops
+        self.choices = choices
+        self.sizes = [len(branches) for branches, _ in choices]
+        # Text of every branch made of literals only (None otherwise), which
+        # lets render() skip the walk of the most common branches
+        self.texts = texts
+        if texts is None:
+            self.texts = [[self.__literal(start, stop) for start, stop in branches]
+                          for branches, _ in choices]
+        # (choice node, branch) directly holding every choice node, None at the
+        # top level. A parent always comes before its children
+        self.parents = parents
+        if parents is None:
+            self.__find_parents()
+
+    def __find_parents(self):
+        ops = self.ops
+        choices = self.choices
+        self.parents = [None] * len(choices)
+        for k, (branches, _) in enumerate(choices):
+            for branch, (start, stop) in enumerate(branches):
+                pc = start
+                while pc < stop:
+                    op = ops[pc]
+                    if op.__class__ is str:
+                        pc += 1
+                    else:
+                        self.parents[op] = (k, branch)
+                        pc = choices[op][1]
+
+    def __literal(self, start, stop):
+        if stop - start == 1:
+            segment = self.ops[start]
+            return segment if segment.__class__ is str else None
+        segments = self.ops[start:stop]
+        if all(segment.__class__ is str for segment in segments):
+            return ''.join(segments)
+        return None
+
+    @classmethod
+    @metrics.timed('program.compile')
+    def compile(cls, masterspin, delimiter='|'):
+        """ Parse the masterspin once into a SpinProgram. As for the regex based
+        spinning, unbalanced braces are kept as plain text
+        """
+        ops = []
+        choices = []
+        stack = []  # (choice index, branches, start of the current branch)
+        for kind, text, _ in tokenize(masterspin, delimiter):
+            if kind == TEXT:
+                ops.append(text)
+            elif kind == OPEN:
+                ops.append(len(choices))
+                choices.append(None)
+                stack.append((len(choices) - 1, [], len(ops)))
+            elif kind == SEP:
+                index, branches, start = stack.pop()
+                branches.append((start, len(ops)))
+                stack.append((index, branches, len(ops)))
+            elif kind == CLOSE:
+                index, branches, start = stack.pop()
+                branches.append((start, len(ops)))
+                choices[index] = (branches, len(ops))
+        return cls(ops, choices)
+
+    def to_bytes(self):
+        """ Convert the program to a compact binary format
+        """
+        strings = {}
+        ops = [op if op.__class__ is int else -1 - strings.setdefault(op, len(strings))
+               for op in self.ops]
+        branches = [bound for choice_branches, _ in self.choices
+                    for branch in choice_branches for bound in branch]
+        first_branch = np.cumsum([0] + self.sizes)
+        next_ops = [next_pc for _, next_pc in self.choices]
+        texts = [-1 if text is None else strings.setdefault(text, len(strings))
+                 for choice_texts in self.texts for text in choice_texts]
+        parents = [bound for parent in self.parents for bound in (parent or (-1, -1))]
+        offsets, blob = pack_strings(list(strings))
+        return b''.join([_HEADER.pack(_MAGIC, _VERSION, len(ops), len(self.choices),
+                                      len(branches) // 2, len(strings), len(blob)),
+                         np.array(ops, dtype=np.int32).tobytes(),
+                         np.array(branches, dtype=np.int32).tobytes(),
+                         first_branch.astype(np.int32).tobytes(),
+                         np.array(next_ops, dtype=np.int32).tobytes(),
+                         np.array(texts, dtype=np.int32).tobytes(),
+                         np.array(parents, dtype=np.int32).tobytes(), offsets, blob])
+
+    @classmethod
+    def from_bytes(cls, data):
+        """ Build a program from the output of to_bytes(), data being any buffer
+        (bytes, memory map...)
+        """
+        if len(data) < _HEADER.size:
+            raise ValueError('Not a spin program in a supported binary format.')
+        magic, version, n_ops, n_choices, n_branches, n_strings, blob_size = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('Not a spin program in a supported binary format.')
+        sizes = (n_ops, 2 * n_branches, n_choices + 1, n_choices, n_branches, 2 * n_choices)
+        if len(data) != _HEADER.size + 4 * sum(sizes) + 4 * (n_strings + 1) + blob_size:
+            raise ValueError('Truncated or damaged spin program.')
+        position = _HEADER.size
+        arrays = []
+        for size in sizes:
+            arrays.append(np.frombuffer(data, dtype=np.int32, count=size, offset=position))
+            position += 4 * size
+        ops, branches, first_branch, next_ops, texts, parents = arrays
+        strings = unpack_strings(data, position, n_strings, blob_size)
+        # Look the ops and the texts up in a single table: choice indexes, then
+        # literals, then None
+        table = np.empty(n_choices + n_strings + 1, dtype=object)
+        table[:n_choices] = range(n_choices)
+        table[n_choices:-1] = strings
+        table[-1] = None
+        ops = table[np.where(ops >= 0, ops, n_choices - 1 - ops)].tolist()
+        texts = table[np.where(texts >= 0, texts + n_choices, -1)].tolist()
+        branches = list(zip(branches[0::2].tolist(), branches[1::2].tolist()))
+        bounds = list(zip(first_branch[:-1].tolist(), first_branch[1:].tolist()))
+        choices = [(branches[start:stop], next_pc) for (start, stop), next_pc in zip(bounds, next_ops.tolist())]
+        texts = [texts[start:stop] for start, stop in bounds]
+        parents = [None if node < 0 else (node, branch)
+                   for node, branch in zip(parents[0::2].tolist(), parents[1::2].tolist())]
+        return cls(ops, choices, texts, parents)
+
+    def save(self, path):
+        """ Save the program to a file in the binary format of to_bytes()
+        """
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        """ Load a program saved by save(), through a memory map of the file
+        """
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return cls.from_bytes(data)
+
+    def draw(self, rand=random):
+        """ Pick a branch at random for every choice node
+        """
+        uniform = rand.random
+        return [int(uniform() * size) for size in self.sizes]
+
+    def trace(self, choices):
+        """ Choice vector of the spun rendered from choices: the branch taken at
+        every choice node, or -1 for the nodes out of the branches taken
+        """
+        vector = list(choices)
+        for k, parent in enumerate(self.parents):
+            if parent is not None and vector[parent[0]] != parent[1]:
+                vector[k] = -1
+        return vector
+
+    def render(self, choices):
+        """ Walk the program once, taking branch choices[k] at the k-th choice
+        node, and return the resulting text
+        """
+        ops = self.ops
+        nodes = self.choices
+        texts = self.texts
+        out = []
+        append = out.append
+        stack = []
+        pc, stop = 0, len(ops)
+        while True:
+            while pc < stop:
+                op = ops[pc]
+                if op.__class__ is str:
+                    append(op)
+                    pc += 1
+                else:
+                    branch = choices[op]
+                    text = texts[op][branch]
+                    branches, next_pc = nodes[op]
+                    if text is not None:
+                        append(text)
+                        pc = next_pc
+                    else:
+                        stack.append((next_pc, stop))
+                        pc, stop = branches[branch]
+            if not stack:
+                return ''.join(out)
+            pc, stop = stack.pop()
+
+    def run(self, rand=random):
+        """ Generate a random text from the program
+        """
+        return self.render(self.draw(rand))
+
+    def sample(self, n, rng, with_choices=False):
+        """ Generate n random texts, drawing the choices of all of them at once
+        as a (n, number of choice nodes) matrix from the NumPy Generator rng.
+        With with_choices, (text, choice vector) pairs are returned instead
+        """
+        if not self.choices:
+            text = self.render(())
+            return [(text, []) for _ in range(n)] if with_choices else [text] * n
+        matrix = rng.integers(0, self.sizes, size=(n, len(self.sizes))).tolist()
+        render = self.render
+        if with_choices:
+            trace = self.trace
+            return [(render(choices), trace(choices)) for choices in matrix]
+        return [render(choices) for choices in matrix]
+
+
+# Program of the worker processes of Spin.generate_parallel(), shipped once
+_worker_program = None
+
+def init_worker(program):
+    global _worker_program
+    _worker_program = program
+
+def sample_chunk(program, index, size, entropy):
+    """ Generate the index-th chunk of spuns from its own random stream, spawned
+    from entropy, so that every chunk is the same whichever process makes it
+    """
+    rng = np.random.default_rng(np.random.SeedSequence(entropy, spawn_key=(index,)))
+    return [spun.strip() for spun in program.sample(size, rng)]
+
+def sample_worker_chunk(index, size, entropy):
+    return sample_chunk(_worker_program, index, size, entropy)
@@ -0,0 +1,225 @@
+'''
+@author: Antonin Duroy
+'''
+
+import json
+import asyncio
+import argparse
+import numpy as np
+
+from collections import OrderedDict
+from hashlib import sha256
+from spin import Spin
+from text_similarity import SimilarityIndex
+
+# Largest number of spuns a single request may ask for
+MAX_SPUNS = 100000
+
+def similarities(query, documents, metric='jaccard'):
+    """ Similarities between query and every document (run in the executor of
+    the service, so kept at module level for process pools)
+    """
+    if not isinstance(query, str) or not all(isinstance(document, str) for document in documents):
+        raise ValueError('query and documents must be strings.')
+    index = SimilarityIndex(metric)
+    for document in documents:
+        index.add(document.split())
+    return index.similarities(query.split()).tolist()
+
+class SpinService():
+    """ Spinning service answering JSON requests, one per line, with one JSON
+    line each (in order of completion, matched by their 'id'):
+        {"op": "load", "masterspin": ...} -> {"hash": ...}
+        {"op": "unspin", "masterspin" or "hash": ..., "n": 1, "seed": null,
+         "delimiter": "|"} -> {"spuns": [...]}
+        {"op": "similarity", "query": ..., "documents": [...],
+         "metric": "jaccard"} -> {"similarities": [...]}
+        {"op": "stats"} -> {"masterspins": ..., "generations": ...}
+    Errors are answered with {"error": ...}, and n is at most MAX_SPUNS
+
+    Parsed masterspins are kept in a LRU cache keyed by the hash of their
+    content. The unspin requests received for the same masterspin while the
+    event loop is busy are generated by a single call (those with a seed being
+    generated on their own, to give the same spuns as Spin.unspin_many()), and
+    similarities are computed in executor (the default one of the loop if None)
+    """
+
+    def __init__(self, cache_size=128, executor=None):
+        self.cache_size = cache_size
+        self.executor = executor
+        self.spins = OrderedDict()
+        self.pending = {}  # (hash, delimiter) -> [(n, seed, future)]
+        self.generations = 0
+        self.rng = np.random.default_rng()
+
+    def load(self, masterspin):
+        """ Return the hash of the masterspin, parsing it unless cached
+        """
+        key = sha256(masterspin.encode('utf-8')).hexdigest()
+        if key in self.spins:
+            self.spins.move_to_end(key)
+        else:
+            self.spins[key] = Spin(masterspin)
+            if len(self.spins) > self.cache_size:
+                self.spins.popitem(last=False)
+        return key
+
+    def get(self, key):
+        spin = self.spins.get(key)
+        if spin is None:
+            raise ValueError('Unknown masterspin: %s' % key)
+        self.spins.move_to_end(key)
+        return spin
+
+    async def unspin(self, key, n=1, seed=None, delimiter='|'):
+        """ Generate n spuns of the masterspin of hash key, along with the other
+        requests for it received meanwhile
+        """
+        spin = self.get(key)
+        spin.compile(delimiter)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self.pending.get((key, delimiter))
+        if batch is None:
+            batch = self.pending[(key, delimiter)] = []
+            loop.call_soon(self.__flush, key, delimiter, spin)
+        batch.append((n, seed, future))
+        return await future
+
+    def __flush(self, key, delimiter, spin):
+        batch = self.pending.pop((key, delimiter))
+        unseeded = [(n, future) for n, seed, future in batch if seed is None]
+        if unseeded:
+            try:
+                spuns = spin.compile(delimiter).sample(sum(n for n, _ in unseeded), self.rng)
+            except Exception as e:
+                # Fail the whole batch rather than leaving its requests pending
+                for _, future in unseeded:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                start = 0
+                for n, future in unseeded:
+                    if not future.done():
+                        future.set_result([spun.strip() for spun in spuns[start:start+n]])
+                    start += n
+            self.generations += 1
+        for n, seed, future in batch:
+            if seed is not None and not future.done():
+                try:
+                    future.set_result(spin.unspin_many(n, seed, delimiter))
+                except Exception as e:
+                    future.set_exception(e)
+                self.generations += 1
+
+    async def handle(self, request):
+        """ Answer a request (a dict) with a dict
+        """
+        if not isinstance(request, dict):
+            raise ValueError('A request must be a JSON object.')
+        op = request.get('op')
+        if op == 'load':
+            return {'hash': self.load(request['masterspin'])}
+        elif op == 'unspin':
+            key = request.get('hash')
+            if key is None:
+                key = self.load(request['masterspin'])
+            n = int(request.get('n', 1))
+            if not 0 <= n <= MAX_SPUNS:
+                raise ValueError('n must be between 0 and %d.' % MAX_SPUNS)
+            spuns = await self.unspin(key, n, request.get('seed'), request.get('delimiter', '|'))
+            return {'spuns': spuns}
+        elif op == 'similarity':
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.executor, similarities, request['query'],
+                                                request['documents'], request.get('metric', 'jaccard'))
+            return {'similarities': result}
+        elif op == 'stats':
+            return {'masterspins': len(self.spins), 'generations': self.generations}
+        raise ValueError('Unknown op: %s' % op)
+
+    async def __answer(self, line, writer, lock):
+        request = {}
+        try:
+            request = json.loads(line)
+            response = await self.handle(request)
+        except Exception as e:
+            # Any failure is answered, so that the client is never left waiting
+            response = {'error': '%s: %s' % (type(e).__name__, e)}
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        await self.__send(response, writer, lock)
+
+    async def __send(self, response, writer, lock):
+        writer.write(json.dumps(response).encode('utf-8') + b'\n')
+        try:
+            async with lock:
+                await writer.drain()
+        except ConnectionError:
+            pass # The client is gone, nobody is left to answer
+
+    async def serve_client(self, reader, writer):
+        """ Answer the requests of a connection concurrently, until it is closed
+
+        A line longer than the limit of the reader is answered with an error and
+        skipped, the following requests being served as usual
+        """
+        tasks = set()
+        lock = asyncio.Lock()
+
+        def schedule(coroutine):
+            task = asyncio.ensure_future(coroutine)
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        skipping = False  # Within a line longer than the limit
+        try:
+            while True:
+                eof = False
+                try:
+                    line = await reader.readuntil(b'\n')
+                except asyncio.IncompleteReadError as e:
+                    line = e.partial
+                    eof = True
+                except asyncio.LimitOverrunError as e:
+                    if not skipping:
+                        skipping = True
+                        schedule(self.__send({'error': 'ValueError: Request line too long.'}, writer, lock))
+                    await reader.readexactly(e.consumed)
+                    continue
+                if skipping:
+                    skipping = False # End of the line too long
+                elif line.strip():
+                    schedule(self.__answer(line, writer, lock))
+                if eof:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            if tasks:
+                await asyncio.wait(tasks)
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8765, limit=1 << 24):
+        """ Start listening and return the asyncio server (lines, i.e. requests,
+        being limited to limit bytes)
+        """
+        return await asyncio.start_server(self.serve_client, host, port, limit=limit)
+
+async def serve(host='127.0.0.1', port=8765, cache_size=128):
+    server = await SpinService(cache_size).start(host, port)
+    async with server:
+        await server.serve_forever()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m spin', description='Spinning service')
+    parser.add_argument('command', choices=['serve'])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cache-size', type=int, default=128,
+                        help='number of parsed masterspins kept in memory')
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args.host, args.port, args.cache_size))
+    except KeyboardInterrupt:
+        pass
@@ -5,20 +5,57 @@
 @author: Antonin Duroy
 '''
 
+import os
 import re
-import random
-import matplotlib.pyplot as plt
+import struct
+import numpy as np
+import metrics
 
-from collections import OrderedDict
-from text_similarity import jaccard_similarity, cosine_similarity, jaro_winkler_similarity
+from collections import deque
+from hashlib import sha256, blake2b
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+from text_similarity import SimilarityIndex
+from choice_similarity import ChoiceSimilarity
+from evaluation import DuplicateEvaluator, METRICS, plot_curves
 from tree import SpinTree
-from utils import insert_at_position
+from analysis import diversity_report
+from program import SpinProgram, sample_chunk, init_worker, sample_worker_chunk
+from spintax import tokenize, SpinSyntaxError, TEXT, OPEN, SEP, CLOSE
+from utils import permuted_range
+
+def _count_spuns(spuns):
+    """ Count the spuns generated, and their size in bytes, if metrics are enabled
+    """
+    if metrics.is_enabled():
+        metrics.count('spin.spuns', len(spuns))
+        metrics.count('spin.generated_bytes', sum(len(spun.encode('utf-8')) for spun in spuns))
+
+def _count_spun(result):
+    """ Count the spun returned by unspin() (alone or with its choice vector)
+    """
+    _count_spuns([result[0] if result.__class__ is tuple else result])
+
+def _count_many(result):
+    """ Count the spuns returned by unspin_many() (alone or with their choice
+    vectors)
+    """
+    _count_spuns([spun[0] if spun.__class__ is tuple else spun for spun in result])
+
+def _observe_tree(tree):
+    """ Record the shape of a tree returned by build_tree()
+    """
+    shape = tree.stats()
+    metrics.observe('tree.nodes', shape['nodes'])
+    metrics.observe('tree.depth', shape['depth'])
 
 class Spin():
     
-    def __init__(self, masterspin=None, input_file=None):
-        # Placeholders used for building tree representation
-        self.placeholders = OrderedDict([])
+    def __init__(self, masterspin=None, input_file=None, cache_dir=None):
+        # Compiled programs used for spinning, by delimiter
+        self.programs = {}
+        # Directory where parsed trees are cached, by hash of the masterspin
+        self.cache_dir = cache_dir
         if masterspin is not None:
             self.masterspin = masterspin
         elif input_file is not None:
@@ -26,18 +63,244 @@ class Spin():
         else:
             raise ValueError("A masterspin must be specified.")
     
-    def unspin(self, delimiter='|'):
-        """ Generate a spun from the masterspin
+    @metrics.timed('spin.unspin', result=_count_spun)
+    def unspin(self, delimiter='|', with_choices=False):
+        """ Generate a spun from the masterspin. With with_choices, return it
+        along with its choice vector: the branch taken at every choice node (in
+        order of appearance in the masterspin), -1 for the nodes not reached
+        """
+        program = self.compile(delimiter)
+        if with_choices:
+            choices = program.draw()
+            return program.render(choices).strip(), program.trace(choices)
+        return program.run().strip()
+    
+    @classmethod
+    def iter_file(cls, path, separator='\n', delimiter='|', encoding='utf-8', buffer_size=1 << 20,
+                  cache_dir=None, max_record_size=1 << 24):
+        """ Lazily read a file holding many masterspins, one per record, and
+        yield a compiled Spin for every record. The file is read buffer_size
+        characters at a time; records end at a separator found outside of
+        braces, the nesting depth being carried over from one buffer to the next
+        
+        Raise a SpinSyntaxError, giving the position (in characters from the
+        start of the file) of the brace left open, if the file ends within
+        braces or if a record grows past max_record_size characters within them
+        """
+        def make_spin(masterspin):
+            spin = cls(masterspin, cache_dir=cache_dir)
+            spin.compile(delimiter)
+            return spin
+        
+        pattern = re.compile('[{}]|' + re.escape(separator))
+        # Characters held back so that a separator is never cut in two
+        hold = len(separator) - 1
+        record = []
+        depth = 0
+        carry = ''
+        offset = 0  # Position of carry in the file
+        record_start = 0
+        open_position = None  # Position of the outermost brace left open
+        # Newlines are only translated for the default separator, so that any
+        # other one (such as '\r\n') is matched as written
+        with open(path, 'r', encoding=encoding, newline=None if separator == '\n' else '') as f:
+            while True:
+                chunk = f.read(buffer_size)
+                data = carry + chunk
+                limit = len(data) - hold if chunk else len(data)
+                start = 0
+                for m in pattern.finditer(data):
+                    if m.start() >= limit:
+                        break
+                    token = m.group()
+                    if token == '{':
+                        if depth == 0:
+                            open_position = offset + m.start()
+                        depth += 1
+                    elif token == '}':
+                        depth = max(0, depth - 1)
+                    elif depth == 0:
+                        record.append(data[start:m.start()])
+                        start = m.end()
+                        record_start = offset + start
+                        masterspin = ''.join(record)
+                        record = []
+                        if masterspin.strip():
+                            yield make_spin(masterspin)
+                end = max(limit, start)
+                if depth > 0 and offset + end - record_start > max_record_size:
+                    raise SpinSyntaxError('Brace left open over %d characters' % max_record_size,
+                                          open_position)
+                record.append(data[start:end])
+                carry = data[end:]
+                offset += end
+                if not chunk:
+                    break
+        if depth > 0:
+            raise SpinSyntaxError('Brace left open at the end of the file', open_position)
+        masterspin = ''.join(record)
+        if masterspin.strip():
+            yield make_spin(masterspin)
+    
+    def write_spuns(self, fp, n, seed=None, delimiter='|', separator='\n', batch_size=1024):
+        """ Generate n spuns and write them to a file-like object, each one
+        followed by separator, without keeping them in memory
+        """
+        for spun in self.iter_unspin(n, seed, delimiter, batch_size):
+            fp.write(spun)
+            fp.write(separator)
+    
+    @metrics.timed('spin.unspin_many', result=_count_many)
+    def unspin_many(self, n, seed=None, delimiter='|', with_choices=False):
+        """ Generate n spuns at once. The same seed always gives the same spuns.
+        With with_choices, (spun, choice vector) pairs are returned, as for
+        unspin()
+        """
+        rng = np.random.default_rng(seed)
+        spuns = self.compile(delimiter).sample(n, rng, with_choices)
+        if with_choices:
+            return [(spun.strip(), choices) for spun, choices in spuns]
+        return [spun.strip() for spun in spuns]
+    
+    def iter_unspin(self, n=None, seed=None, delimiter='|', batch_size=1024):
+        """ Lazily generate n spuns (endlessly if n is None), batch_size at a
+        time. With the same seed, the spuns are the same as unspin_many()
+        """
+        program = self.compile(delimiter)
+        rng = np.random.default_rng(seed)
+        while n is None or n > 0:
+            size = batch_size if n is None else min(batch_size, n)
+            with metrics.timer('spin.iter_unspin_batch'):
+                spuns = [spun.strip() for spun in program.sample(size, rng)]
+            _count_spuns(spuns)
+            for spun in spuns:
+                yield spun
+            if n is not None:
+                n -= size
+    
+    def unique_spuns(self, n=None, seed=None, delimiter='|'):
+        """ Lazily generate up to n distinct spuns (all of them if n is None).
+        The combinations of choices are visited through a seeded shuffle of their
+        indexes, and a 128-bit digest of every spun yielded is kept, so that the
+        spuns an ambiguous masterspin (as '{a|a}' or '{a|ab}{b|}') gives for
+        several combinations are only yielded once. The generator stops when the
+        combinations are exhausted
         """
-        spun_string = self.masterspin
-        while True:
-            spun_string, n = re.subn('{([^{}]*)}',
-                lambda m: random.choice(m.group(1).split(delimiter)),
-                spun_string)
-            if n == 0:
-                break
-        return spun_string.strip()
+        tree = self.build_tree(delimiter)
+        seen = set()
+        for index in permuted_range(tree.count(), seed):
+            if n is not None and len(seen) >= n:
+                return
+            spun = tree.unrank(index).strip()
+            digest = int.from_bytes(blake2b(spun.encode('utf-8'), digest_size=16).digest(), 'big')
+            if digest not in seen:
+                seen.add(digest)
+                yield spun
     
+    def diverse_spuns(self, n, metric='jaccard', seed=None, delimiter='|', pool_size=32):
+        """ Lazily generate n spuns, greedily picking every next one so as to
+        minimize its highest similarity (metric being 'jaccard' or 'cosine') with
+        the spuns already picked (farthest-first selection)
+        
+        The spuns are picked from a pool of candidates, half of them taking the
+        branches used the least so far and half of them random. The highest
+        similarity of every candidate is kept up to date as spuns are picked, so
+        a step only compares the pool with the last spun picked, and the fresh
+        candidate replacing it with the index of the spuns picked
+        """
+        program = self.compile(delimiter)
+        rng = np.random.default_rng(seed)
+        index = SimilarityIndex(metric)
+        sizes = np.array(program.sizes, dtype=np.int64)
+        first_branch = np.cumsum(sizes) - sizes
+        nodes = np.repeat(np.arange(len(sizes)), sizes)
+        usage = np.zeros(len(nodes))
+        
+        def candidate(least_used):
+            if least_used:
+                # Least used branch of every node, ties broken at random
+                order = np.lexsort((usage + rng.random(len(usage)), nodes))
+                choices = order[first_branch] - first_branch
+            else:
+                choices = rng.integers(0, sizes)
+            spun = program.render(choices.tolist()).strip()
+            tokens = spun.split()
+            return [index.max_similarity(tokens), choices, spun, index.weights(tokens)]
+        
+        pool = [candidate(i % 2 == 0) for i in range(pool_size)]
+        for step in range(n):
+            best = min(range(pool_size), key=lambda i: pool[i][0])
+            _, choices, spun, weights = pool[best]
+            yield spun
+            index.add(spun.split())
+            usage[first_branch + choices] += 1
+            for other in pool:
+                other[0] = max(other[0], index.similarity(other[3], weights))
+            pool[best] = candidate(step % 2 == 1)
+    
+    def enumerate(self, start=0, stop=None, delimiter='|'):
+        """ Lazily generate every spun of indexes start to stop, in a fixed
+        order, so that a large masterspin can be split across workers
+        """
+        for spun in self.build_tree(delimiter).iter_all(start, stop):
+            yield spun.strip()
+    
+    def generate_parallel(self, n, workers=None, seed=None, delimiter='|', chunk_size=1000, ordered=True):
+        """ Lazily generate n spuns with a pool of worker processes (as many as
+        CPUs if workers is None). The compiled masterspin is sent once to every
+        worker, then each chunk of chunk_size spuns is drawn from its own random
+        stream spawned from the seed: the same seed and chunk_size give the same
+        spuns whatever the number of workers. If ordered is False, chunks are
+        yielded as soon as they are ready
+        """
+        program = self.compile(delimiter)
+        entropy = np.random.SeedSequence(seed).entropy
+        chunks = [(index, min(chunk_size, n - start), entropy)
+                  for index, start in enumerate(range(0, n, chunk_size))]
+        if workers == 1:
+            for chunk in chunks:
+                spuns = sample_chunk(program, *chunk)
+                _count_spuns(spuns)
+                for spun in spuns:
+                    yield spun
+            return
+        
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(program,)) as executor:
+            pending = deque()
+            chunks = iter(chunks)
+            try:
+                # Keep a bounded number of chunks in flight
+                for chunk in islice(chunks, 2 * workers):
+                    pending.append(executor.submit(sample_worker_chunk, *chunk))
+                while pending:
+                    if ordered:
+                        future = pending.popleft()
+                    else:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        future = done.pop()
+                        pending.remove(future)
+                    for chunk in islice(chunks, 1):
+                        pending.append(executor.submit(sample_worker_chunk, *chunk))
+                    spuns = future.result()
+                    _count_spuns(spuns)
+                    for spun in spuns:
+                        yield spun
+            finally:
+                for future in pending:
+                    future.cancel()
+    
+    def compile(self, delimiter='|'):
+        """ Return the compiled program of the masterspin, parsed on first use
+        """
+        program = self.programs.get(delimiter)
+        if program is None:
+            program = self.__cached(delimiter, '.spp', SpinProgram,
+                                    lambda delimiter: SpinProgram.compile(self.masterspin, delimiter))
+            self.programs[delimiter] = program
+        return program
+    
+    @metrics.timed('spin.build_tree', result=_observe_tree)
     def build_tree(self, delimiter='|'):
         """ Build a tree representation of the masterspin
         e.g.:
@@ -52,123 +315,120 @@ class Spin():
                 +--- (OR)
                      +--- d
                      +--- e
+        
+        Raise a SpinSyntaxError, giving the position of the faulty brace, if
+        the masterspin is not balanced
+        
+        If the Spin has a cache_dir, the tree is read from there when the same
+        masterspin has already been parsed, and stored there otherwise (the
+        same goes for the compiled program used for spinning)
+        """
+        return self.__cached(delimiter, '.spt', SpinTree, self.__parse_tree)
+    
+    def __cached(self, delimiter, extension, cls, build):
+        """ Build an object of cls from the masterspin, or load it from the cache
+        directory (where it is saved through cls.save() otherwise) if any
         """
-        def repl(a):
-            """ Replacement function for every non-overlapping occurrence of pattern in re.subn()
+        if self.cache_dir is None:
+            return build(delimiter)
+        key = sha256(('%s\0%s' % (delimiter, self.masterspin)).encode('utf-8')).hexdigest()
+        path = os.path.join(self.cache_dir, key + extension)
+        if os.path.exists(path):
+            try:
+                return cls.load(path)
+            except (ValueError, struct.error, BufferError):
+                # Written in another version of the format, or damaged (an error
+                # raised while the file is mapped surfaces as a BufferError when
+                # the map closes): build it again
+                pass
+        built = build(delimiter)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        built.save(tmp_path)
+        os.replace(tmp_path, path)
+        return built
+    
+    @metrics.timed('spin.parse_tree')
+    def __parse_tree(self, delimiter):
+        def to_node(chunks):
+            """ Turn the chunks (strings and subtrees) of a sequence into a node
             """
-            perforations = a.group(1).split(delimiter)
-            parent = SpinTree(or_=True)
-            placeholder = '__NODE__'+str(random.randint(0, 10000))
-            while placeholder in self.placeholders:
-                placeholder = '__NODE__'+str(random.randint(0, 10000))
-            insert_index = -1
-            for perfo in perforations:
-                s_perfo = [perfo]
-                for ph in self.placeholders:
-                    for i, chunk in enumerate(s_perfo):
-                        if isinstance(chunk, SpinTree):
-                            continue
-                        sp = chunk.split(ph)
-                        if len(sp) == 2: # Because every placeholder is unique
-                            s_perfo = [node for node in s_perfo[:i] + [sp[0], self.placeholders[ph], sp[1]] + s_perfo[i+1:] if node != '']
-                            insert_index = list(self.placeholders.keys()).index(ph)
-                            self.placeholders.pop(ph)
-                            break
-                if len(s_perfo) == 1 and not isinstance(s_perfo[0], SpinTree):
-                    child = SpinTree(value=perfo)
-                elif len(s_perfo) == 1 and isinstance(s_perfo[0], SpinTree):
-                    child = s_perfo[0]
-                else:
-                    child = SpinTree(and_=True)
-                    for and_child in s_perfo:
-                        if isinstance(and_child, SpinTree):
-                            child.add_child(and_child)
-                        else:
-                            child.add_child(SpinTree(value=and_child))
-                parent.add_child(child)
-            # Insert the new placeholder at the right position
-            self.placeholders = insert_at_position(self.placeholders, insert_index, (placeholder, parent))
-            return placeholder
+            if not chunks:
+                return SpinTree(value='')
+            if len(chunks) == 1:
+                chunk = chunks[0]
+                return chunk if isinstance(chunk, SpinTree) else SpinTree(value=chunk)
+            node = SpinTree(and_=True)
+            for chunk in chunks:
+                node.add_child(chunk if isinstance(chunk, SpinTree) else SpinTree(value=chunk))
+            return node
         
-        masterspin = self.masterspin
-        while True:
-            masterspin, n = re.subn('{([^{}]*)}',
-                repl,
-                masterspin)
-            if n == 0:
-                s_masterspin = [masterspin]
-                for ph in self.placeholders:
-                    for i, chunk in enumerate(s_masterspin):
-                        if isinstance(chunk, SpinTree):
-                            continue
-                        sp = chunk.split(ph)
-                        if len(sp) == 2: # Because every placeholder is unique
-                            s_masterspin = [node for node in s_masterspin[:i] + [sp[0], self.placeholders[ph], sp[1]] + s_masterspin[i+1:] if node != '']
-                            self.placeholders.pop(ph)
-                            break
-                if len(s_masterspin) == 1 and not isinstance(s_masterspin[0], SpinTree):
-                    return SpinTree(value=masterspin)
-                elif len(s_masterspin) == 1 and isinstance(s_masterspin[0], SpinTree):
-                    return s_masterspin[0]
-                else:
-                    final_tree = SpinTree(and_=True)
-                    for and_child in s_masterspin:
-                        if isinstance(and_child, SpinTree):
-                            final_tree.add_child(and_child)
-                        else:
-                            final_tree.add_child(SpinTree(value=and_child))
-                    return final_tree
+        # Each open group is an OR node along with the chunks of its current branch
+        stack = []
+        chunks = []
+        for kind, text, _ in tokenize(self.masterspin, delimiter, strict=True):
+            if kind == TEXT:
+                chunks.append(text)
+            elif kind == OPEN:
+                stack.append((SpinTree(or_=True), chunks))
+                chunks = []
+            elif kind == SEP:
+                stack[-1][0].add_child(to_node(chunks))
+                chunks = []
+            elif kind == CLOSE:
+                parent, parent_chunks = stack.pop()
+                parent.add_child(to_node(chunks))
+                parent_chunks.append(parent)
+                chunks = parent_chunks
+        return to_node(chunks)
+    
+    def choice_similarity(self, delimiter='|'):
+        """ ChoiceSimilarity of the spuns, comparing them through their choice
+        vectors (see unspin()) rather than their text
+        """
+        return ChoiceSimilarity(self.compile(delimiter))
+    
+    def diversity_report(self, n=None, delimiter='|'):
+        """ Estimate the diversity of the spuns straight from the tree, without
+        generating any (see analysis.diversity_report())
+        """
+        return diversity_report(self.build_tree(delimiter), n)
+    
+    def evaluate_duplicates(self, n, directory=None, checkpoint_every=1000, seed=None,
+                            measures=('jaccard', 'cosine'), delimiter='|'):
+        """ Stream n spuns through a DuplicateEvaluator and return it, its curves
+        giving the highest similarity of every spun with the previous ones
+        
+        If directory is given, the spuns, the curves (as CSV and NPY) and the
+        random state are saved there every checkpoint_every spuns, and an
+        evaluation found there is resumed (with its own measures and random
+        state) instead of starting over
+        """
+        evaluator = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            evaluator = DuplicateEvaluator.resume(directory)
+        rng = np.random.default_rng(seed)
+        if evaluator is None:
+            evaluator = DuplicateEvaluator(measures)
+        else:
+            rng.bit_generator.state = evaluator.rng_state
+        program = self.compile(delimiter)
+        while len(evaluator) < n:
+            spuns = [spun.strip() for spun in program.sample(min(checkpoint_every, n - len(evaluator)), rng)]
+            evaluator.update(spuns)
+            if directory is not None:
+                evaluator.rng_state = rng.bit_generator.state
+                evaluator.checkpoint(directory, spuns)
+        return evaluator
     
     def plot_duplicate_evolution(self, iterations, save_file=None):
         """ Generate n (=iterations) spuns and compare their similarities 2 by 2, then plot
         or save the results in order to visualize the masterpin limit
         """
-        def add_subplot(x, y, title, position):
-            """
-            """
-            plt.subplot(position)
-            plt.bar(x, y)
-            plt.grid(True)
-            plt.title(title)
-            x1,x2,y1,y2 = plt.axis()
-            plt.axis((x1,x2,y1,1))
-        
-        spuns = []
-        x = []
-        jaccard_sim = []
-        jaro_winkler_sim = []
-        cosine_sim = []
-        for i in range(iterations):
-            x.append(i)
-            new_spun = self.unspin()
-            tmp_max_jaccard = 0
-            tmp_max_jaro_winkler = 0
-            tmp_max_cosine = 0
-            for spun in spuns:
-                split_spun = spun.split()
-                split_new_spun = new_spun.split()
-                tmp_max_jaccard = max(tmp_max_jaccard, jaccard_similarity(split_new_spun, split_spun))
-                tmp_max_jaro_winkler = max(tmp_max_jaro_winkler, jaro_winkler_similarity(split_new_spun, split_spun))
-                tmp_max_cosine = max(tmp_max_cosine, cosine_similarity(split_new_spun, split_spun))
-                
-            jaccard_sim.append(tmp_max_jaccard)
-            jaro_winkler_sim.append(tmp_max_jaro_winkler)
-            cosine_sim.append(tmp_max_cosine)
-            spuns.append(new_spun)
-        
-        # Jaccard
-        add_subplot(x, sorted(jaccard_sim), 'Jaccard', 311)
-        
-        # Jaro Winkler
-        add_subplot(x, sorted(jaro_winkler_sim), 'Jaro Winkler', 312)
-        
-        # Cosine
-        add_subplot(x, sorted(cosine_sim), 'Cosine', 313)
-        
-        if save_file is not None:
-            plt.savefig(save_file)
-        else:
-            plt.show()
+        evaluator = DuplicateEvaluator(METRICS)
+        evaluator.update(self.unspin_many(iterations))
+        plot_curves(evaluator.curves, save_file)
     
     def __open_file(self, path):
         with open(path, "r", encoding='utf-8') as masterspin:
@@ -176,6 +436,11 @@ class Spin():
 
 
 if __name__ == "__main__":
+    import sys
+    if sys.argv[1:2] == ['serve']:
+        import service
+        service.main(sys.argv[1:])
+        sys.exit()
 #    spin = Spin(input_file='')
     spin = Spin("{My name is|I{ am|'m}} John Doe and I {truly|really} love the {spintax|spin framework}{.|!}")
     tree = spin.build_tree()
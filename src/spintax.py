@@ -0,0 +1,74 @@
+'''
+@author: Antonin Duroy
+'''
+
+import re
+
+# Token kinds produced by tokenize()
+TEXT = 0
+OPEN = 1
+SEP = 2
+CLOSE = 3
+
+_BRACES = re.compile('[{}]')
+
+class SpinSyntaxError(ValueError):
+    """ Raised when a masterspin has unbalanced braces
+    """
+
+    def __init__(self, message, position):
+        ValueError.__init__(self, '%s at position %d' % (message, position))
+        self.position = position
+
+def match_braces(masterspin, strict=False):
+    """ Return the set of positions of the braces which open or close a group.
+    Unbalanced braces are left out (they are plain text for the regex based
+    spinning), unless strict is True, in which case a SpinSyntaxError is raised
+    """
+    stack = []
+    paired = set()
+    for m in _BRACES.finditer(masterspin):
+        position = m.start()
+        if m.group() == '{':
+            stack.append(position)
+        elif stack:
+            paired.add(stack.pop())
+            paired.add(position)
+        elif strict:
+            raise SpinSyntaxError("Unbalanced '}'", position)
+    if stack and strict:
+        raise SpinSyntaxError("Unclosed '{'", stack[-1])
+    return paired
+
+def tokenize(masterspin, delimiter='|', strict=False):
+    """ Scan the masterspin once and yield (kind, text, position) tokens, where
+    kind is one of TEXT, OPEN, SEP and CLOSE. Consecutive text is merged into a
+    single TEXT token, delimiters outside of any group are plain text.
+    """
+    if not delimiter:
+        raise ValueError('Delimiter must be a non-empty string.')
+    paired = match_braces(masterspin, strict)
+    pattern = re.compile('[{}]|' + re.escape(delimiter))
+    depth = 0
+    text_start = 0
+    for m in pattern.finditer(masterspin):
+        position = m.start()
+        token = m.group()
+        if token == '{' and position in paired:
+            kind = OPEN
+        elif token == '}' and position in paired:
+            kind = CLOSE
+        elif token == delimiter and depth > 0:
+            kind = SEP
+        else:
+            continue
+        if text_start < position:
+            yield (TEXT, masterspin[text_start:position], text_start)
+        yield (kind, token, position)
+        if kind == OPEN:
+            depth += 1
+        elif kind == CLOSE:
+            depth -= 1
+        text_start = m.end()
+    if text_start < len(masterspin):
+        yield (TEXT, masterspin[text_start:], text_start)
@@ -3,14 +3,18 @@
 '''
 
 import numpy as np
+import metrics
 
-from math import floor
+from array import array
+from collections import Counter
+from math import floor, sqrt
+from scipy.sparse import csr_matrix
 from scipy.spatial.distance import cosine
-from nltk.probability import FreqDist
 
 ###############################################################################
 # JACCARD SIMILARITY
 ###############################################################################
+@metrics.timed('similarity.jaccard_similarity', 1)
 def jaccard_similarity(seq1, seq2):
     """ 1 means that seq1 and seq2 are equal
     0 means that seq1 and seq2 are completely different
@@ -24,50 +28,122 @@ def jaccard_similarity(seq1, seq2):
 ###############################################################################
 # JARO WINKLER SIMILARITY
 ###############################################################################
-def areEqual(seq1, index1, seq2, index2):
-    try:
-        return seq1[index1] == seq2[index2]
-    except IndexError:
-        return False
-
-def normalizeWindow(start, end, max_limit, min_limit=0):
-    if start < min_limit:
-        start = min_limit
-    if end > max_limit:
-        end = max_limit
-    return range(start, end)
-
+@metrics.timed('similarity.jaro_winkler_similarity', 1)
 def jaro_winkler_similarity(seq1, seq2, prefix_len=3, coef=0.1):
     """ 1 means that seq1 and seq2 are equal
     0 means that seq1 and seq2 are completely different
+    
+    Tokens match if they are equal and not farther apart than the match window
+    (half of the longest sequence, minus one), each token being matched at most
+    once. The Winkler bonus applies to the common prefix, up to prefix_len tokens
     """
     size1 = len(seq1)
     size2 = len(seq2)
-    window = floor(max(size1, size2)/2) - 1
+    if size1 == 0 or size2 == 0:
+        return 1.0 if size1 == size2 else 0.0
+    window = max(0, max(size1, size2)//2 - 1)
+    
+    # Positions of every token in seq2. Both the window and the matched tokens
+    # only move forward, so one cursor per token is enough to find the first
+    # unmatched token of the window
+    positions = {}
+    for j, token in enumerate(seq2):
+        positions.setdefault(token, []).append(j)
+    cursors = dict.fromkeys(positions, 0)
+    matched1 = []
+    matched2 = [False] * size2
+    for i, token in enumerate(seq1):
+        token_positions = positions.get(token)
+        if token_positions is None:
+            continue
+        cursor = cursors[token]
+        while cursor < len(token_positions) and token_positions[cursor] < i - window:
+            cursor += 1
+        if cursor < len(token_positions) and token_positions[cursor] <= i + window:
+            matched2[token_positions[cursor]] = True
+            matched1.append(token)
+            cursor += 1
+        cursors[token] = cursor
     
-    matching_tokens = []
-    transpositions = []
-    for i, token1 in enumerate(seq1):
-        for j, token2 in enumerate(seq2):
-            if j in normalizeWindow(i-window, i+window, max(size1, size2)) and token1 == token2:
-                if i != j and areEqual(seq1, j, seq2, i):
-                    transpositions.append((token1, seq1[j]))
-                matching_tokens.append(token1)
-                
-    jaro_m = len(matching_tokens)
-    jaro_t = floor(len(transpositions)/2)
+    jaro_m = len(matched1)
+    if jaro_m == 0:
+        return 0.0
+    matched2 = [token for j, token in enumerate(seq2) if matched2[j]]
+    jaro_t = sum(1 for token1, token2 in zip(matched1, matched2) if token1 != token2) // 2
     
     jaro_dist = (jaro_m/size1 + jaro_m/size2 + (jaro_m-jaro_t)/jaro_m)/3
     
+    jaro_l = 0
+    for token1, token2 in zip(seq1[:prefix_len], seq2[:prefix_len]):
+        if token1 != token2:
+            break
+        jaro_l += 1
     jaro_p = coef
-    jaro_l = prefix_len
     jaro_winkler_dist = jaro_dist + (jaro_l*jaro_p*(1-jaro_dist))
     
     return jaro_winkler_dist
+
+@metrics.timed('similarity.jaro_winkler_many', lambda query, candidates, *args, **kwargs: len(candidates))
+def jaro_winkler_many(query, candidates, prefix_len=3, coef=0.1):
+    """ Jaro-Winkler similarities between query and every candidate, all of them
+    being sequences of interned token ids (see intern_tokens()), as a NumPy array
+    
+    The positions of the tokens of the query are indexed once, then every
+    candidate is scanned against them, as jaro_winkler_similarity(candidate,
+    query) would (the similarity being symmetric)
+    """
+    if isinstance(query, np.ndarray):
+        query = query.tolist()
+    size2 = len(query)
+    positions = {}
+    for j, token in enumerate(query):
+        positions.setdefault(token, []).append(j)
+    get_positions = positions.get
+    prefix = query[:prefix_len]
+    similarities = np.zeros(len(candidates))
+    for k, candidate in enumerate(candidates):
+        if isinstance(candidate, np.ndarray):
+            candidate = candidate.tolist()
+        size1 = len(candidate)
+        if size1 == 0 or size2 == 0:
+            similarities[k] = 1.0 if size1 == size2 else 0.0
+            continue
+        window = max(0, max(size1, size2)//2 - 1)
+        cursors = {}
+        matched1 = []
+        matched2 = []
+        for i, token in enumerate(candidate):
+            token_positions = get_positions(token)
+            if token_positions is None:
+                continue
+            cursor = cursors.get(token, 0)
+            count = len(token_positions)
+            while cursor < count and token_positions[cursor] < i - window:
+                cursor += 1
+            if cursor < count and token_positions[cursor] <= i + window:
+                matched2.append(token_positions[cursor])
+                matched1.append(token)
+                cursors[token] = cursor + 1
+            else:
+                cursors[token] = cursor
+        jaro_m = len(matched1)
+        if jaro_m == 0:
+            continue
+        matched2.sort()
+        jaro_t = sum(1 for token1, j in zip(matched1, matched2) if token1 != query[j]) // 2
+        jaro_dist = (jaro_m/size1 + jaro_m/size2 + (jaro_m-jaro_t)/jaro_m)/3
+        jaro_l = 0
+        for token1, token2 in zip(candidate[:prefix_len], prefix):
+            if token1 != token2:
+                break
+            jaro_l += 1
+        similarities[k] = jaro_dist + (jaro_l*coef*(1-jaro_dist))
+    return similarities
     
 ###############################################################################
 # COSINE SIMILARITY
 ###############################################################################
+@metrics.timed('similarity.cosine_similarity', 1)
 def cosine_similarity(seq1, seq2):
     """ 1 means that seq1 and seq2 are equal
     0 means that seq1 and seq2 are completely different
@@ -86,6 +162,7 @@ def cosine_similarity(seq1, seq2):
 ###############################################################################
 # HAMMING DISTANCE
 ###############################################################################
+@metrics.timed('similarity.hamming_distance', 1)
 def hamming_distance(seq1, seq2):
     """ 0 means that seq1 and seq2 are equal
     seq1 and seq2 must be of equal lengths
@@ -102,76 +179,335 @@ def hamming_distance(seq1, seq2):
 ###############################################################################
 # LEVENSHTEIN DISTANCE
 ###############################################################################
-def levenshtein_similarity(seq1, seq2):
+@metrics.timed('similarity.levenshtein_similarity')
+def levenshtein_similarity(seq1, seq2, threshold=None):
     """ 1 means that seq1 and seq2 are equal
     0 means that seq1 and seq2 are completely different
                               LD(term1,term2)
     sim(term1,term2) = 1 - ----------------------
                             max(|term1|,|term2|)
+    
+    If a threshold is given, the distance computation stops as soon as the
+    similarity is known to be below it, and 0 is returned in that case
     """
-    return 1 - (levenshtein_distance(seq1, seq2) / max(len(seq1), len(seq2)))
+    size = max(len(seq1), len(seq2))
+    if size == 0:
+        return 1.0
+    if threshold is None:
+        return 1 - (levenshtein_distance(seq1, seq2) / size)
+    max_distance = floor((1 - threshold) * size + 1e-9)
+    distance = levenshtein_distance(seq1, seq2, max_distance)
+    if distance > max_distance:
+        return 0.0
+    return 1 - (distance / size)
 
-def levenshtein_distance(seq1, seq2):
+@metrics.timed('similarity.levenshtein_distance', 1)
+def levenshtein_distance(seq1, seq2, max_distance=None):
     """ 0 means that seq1 and seq2 are equal
     
-    NB: Well suited for small sequences
+    Sequences of any hashable tokens are accepted, interned token ids (see
+    intern_tokens()) being the fastest to compare. If max_distance is given and
+    the distance is greater, max_distance + 1 is returned as soon as it is known
     """
-    size1 = len(seq1) + 1
-    size2 = len(seq2) + 1
-    
-    dist_mat = np.zeros((size1, size2))
-    for i in range(size1):
-        dist_mat[i, 0] = i
-    for j in range(size2):
-        dist_mat[0, j] = j
-    
-    for i in range(1, size1):
-        for j in range(1, size2):
-            cost = 0
-            if seq1[i-1] != seq2[j-1]:
-                cost = 1
-            dist_mat[i][j] = min(dist_mat[i-1][j] + 1,      # Deletion
-                                 dist_mat[i][j-1] + 1,      # Insertion
-                                 dist_mat[i-1][j-1] + cost) # Substitution
-    
-    return dist_mat[size1-1][size2-1]
+    if max_distance is not None:
+        # The band only pays off while narrow: a wide one costs more than the
+        # bit-parallel algorithm on the whole sequences
+        if 2 * max_distance + 1 <= 16 + min(len(seq1), len(seq2)) // 64:
+            return _banded_levenshtein_distance(seq1, seq2, max_distance)
+        return min(_myers_levenshtein_distance(seq1, seq2), max_distance + 1)
+    return _myers_levenshtein_distance(seq1, seq2)
+
+def _myers_levenshtein_distance(seq1, seq2):
+    """ Distance without cutoff
+    """
+    # Bit-parallel algorithm (Myers, 1999): column j of the distance matrix is
+    # encoded by the bit vectors of its vertical +1 (pv) and -1 (mv) deltas
+    if len(seq1) > len(seq2):
+        seq1, seq2 = seq2, seq1
+    size1 = len(seq1)
+    if size1 == 0:
+        return len(seq2)
+    peq = {}
+    for i, token in enumerate(seq1):
+        peq[token] = peq.get(token, 0) | (1 << i)
+    full = (1 << size1) - 1
+    last = 1 << (size1 - 1)
+    pv = full
+    mv = 0
+    distance = size1
+    for token in seq2:
+        eq = peq.get(token, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)
+        mh = pv & xh
+        if ph & last:
+            distance += 1
+        elif mh & last:
+            distance -= 1
+        ph = (ph << 1) | 1
+        mh = mh << 1
+        pv = (mh | ~(xv | ph)) & full
+        mv = ph & xv & full
+    return distance
+
+def _banded_levenshtein_distance(seq1, seq2, max_distance):
+    """ Two-row dynamic programming restricted to the diagonal band of width
+    max_distance, stopping as soon as a whole row exceeds it
+    """
+    if len(seq1) > len(seq2):
+        seq1, seq2 = seq2, seq1
+    size1 = len(seq1)
+    size2 = len(seq2)
+    over = max_distance + 1
+    if size2 - size1 > max_distance:
+        return over
+    previous = [min(j, over) for j in range(size2 + 1)]
+    current = [over] * (size2 + 1)
+    for i in range(1, size1 + 1):
+        start = max(1, i - max_distance)
+        stop = min(size2, i + max_distance)
+        current[start-1] = min(i, over) if start == 1 else over
+        if stop < size2:
+            current[stop+1] = over
+        token = seq1[i-1]
+        row_min = current[start-1]
+        for j in range(start, stop + 1):
+            value = previous[j-1] if seq2[j-1] == token else previous[j-1] + 1 # Substitution
+            if previous[j] + 1 < value:
+                value = previous[j] + 1     # Deletion
+            if current[j-1] + 1 < value:
+                value = current[j-1] + 1    # Insertion
+            if value > over:
+                value = over
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            return over
+        previous, current = current, previous
+    return previous[size2]
 
 ###############################################################################
 # MINKOWSKI DISTANCE
 ###############################################################################
+@metrics.timed('similarity.minkowski_distance')
 def minkowski_distance(seq1, seq2, p):
     """ 0 means that seq1 and seq2 are equal
     1 means that seq1 and seq2 are completely different
     """
-    boi = list(set(seq1).union(set(seq2)))  # Bag of items
-    
-    fdist1 = FreqDist(seq1)
-    fdist2 = FreqDist(seq2)
-    
-    inst1 = np.array([fdist1[item] for item in boi])
-    inst2 = np.array([fdist2[item] for item in boi])
-    
-    distance = 0
-    for i, freq in enumerate(inst1):
-        distance += abs(inst1[i] - inst2[i]) ** p
-    
-    distance = distance ** (1/p)
-    return distance
+    counts, _ = count_matrix([seq1, seq2])
+    return minkowski_distances(counts[0], counts[1], p)[0, 0]
+
+def _pairs(counts1, counts2=None, p=2):
+    """ Number of comparisons made by minkowski_distances()
+    """
+    return counts1.shape[0] * (counts1 if counts2 is None else counts2).shape[0]
+
+@metrics.timed('similarity.minkowski_distances', _pairs)
+def minkowski_distances(counts1, counts2=None, p=2):
+    """ (n1 x n2) matrix of the Minkowski distances between the rows of two
+    sparse count matrices built with a shared vocabulary (see count_matrix()),
+    or between the rows of counts1 if counts2 is None
+    """
+    counts1, counts2 = _same_width(counts1, counts1 if counts2 is None else counts2)
+    if p == 2:
+        squares1 = np.asarray(counts1.multiply(counts1).sum(axis=1))
+        squares2 = np.asarray(counts2.multiply(counts2).sum(axis=1)).T
+        squares = squares1 + squares2 - 2 * counts1.dot(counts2.T).toarray()
+        return np.sqrt(np.maximum(squares, 0))
+    distances = np.zeros((counts1.shape[0], counts2.shape[0]))
+    repeat = np.zeros(counts2.shape[0], dtype=np.intp)
+    for i in range(counts1.shape[0]):
+        difference = abs(counts2 - counts1[i][repeat])
+        distances[i] = np.asarray(difference.power(p).sum(axis=1)).ravel()
+    return distances ** (1/p)
+
+def _same_width(counts1, counts2):
+    """ Pad the count matrices with empty columns up to the same vocabulary size,
+    for matrices built at different times from a growing vocabulary
+    """
+    width = max(counts1.shape[1], counts2.shape[1])
+    if counts1.shape[1] < width:
+        counts1 = csr_matrix((counts1.data, counts1.indices, counts1.indptr), shape=(counts1.shape[0], width))
+    if counts2.shape[1] < width:
+        counts2 = csr_matrix((counts2.data, counts2.indices, counts2.indptr), shape=(counts2.shape[0], width))
+    return counts1, counts2
 
 ###############################################################################
 # MANHATTAN DISTANCE
 ###############################################################################
+@metrics.timed('similarity.manhattan_distance')
 def manhattan_distance(seq1, seq2):
     """ 0 means that seq1 and seq2 are equal
     1 means that seq1 and seq2 are completely different
     """
     return minkowski_distance(seq1, seq2, 1)
 
+@metrics.timed('similarity.manhattan_distances')
+def manhattan_distances(counts1, counts2=None):
+    """ Matrix of the Manhattan distances between the rows of count matrices
+    """
+    return minkowski_distances(counts1, counts2, 1)
+
 ###############################################################################
 # EUCLIDEAN DISTANCE
 ###############################################################################
+@metrics.timed('similarity.euclidean_distance')
 def euclidean_distance(seq1, seq2):
     """ 0 means that seq1 and seq2 are equal
     1 means that seq1 and seq2 are completely different
     """
-    return minkowski_distance(seq1, seq2, 2)
\ No newline at end of file
+    return minkowski_distance(seq1, seq2, 2)
+
+@metrics.timed('similarity.euclidean_distances')
+def euclidean_distances(counts1, counts2=None):
+    """ Matrix of the Euclidean distances between the rows of count matrices
+    """
+    return minkowski_distances(counts1, counts2, 2)
+
+###############################################################################
+# SIMILARITY MATRIX
+###############################################################################
+@metrics.timed('similarity.intern_tokens')
+def intern_tokens(seqs, vocabulary=None):
+    """ Replace every token of the sequences by an integer id, the same token
+    always getting the same id. vocabulary (token -> id) is updated in place
+    and returned along with the list of id sequences
+    """
+    if vocabulary is None:
+        vocabulary = {}
+    setdefault = vocabulary.setdefault
+    ids = [[setdefault(token, len(vocabulary)) for token in seq] for seq in seqs]
+    return ids, vocabulary
+
+@metrics.timed('similarity.count_matrix')
+def count_matrix(seqs, vocabulary=None):
+    """ Sparse (number of sequences x size of vocabulary) matrix of the token
+    counts of every sequence, returned along with the vocabulary
+    """
+    ids, vocabulary = intern_tokens(seqs, vocabulary)
+    indptr = np.zeros(len(ids) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(seq) for seq in ids])
+    indices = np.fromiter((token for seq in ids for token in seq), dtype=np.int64, count=indptr[-1])
+    data = np.ones(len(indices), dtype=np.float64)
+    matrix = csr_matrix((data, indices, indptr), shape=(len(ids), len(vocabulary)))
+    matrix.sum_duplicates()
+    return matrix, vocabulary
+
+@metrics.timed('similarity.similarity_matrix')
+def similarity_matrix(docs, metric='jaccard', tokenize=str.split):
+    """ (n x n) matrix of the similarities between every pair of documents,
+    each document being tokenized once. metric is either 'jaccard' (on the
+    sets of tokens) or 'cosine' (on the token counts)
+    """
+    counts, _ = count_matrix([tokenize(doc) for doc in docs])
+    metrics.count('similarity.comparisons', counts.shape[0] ** 2)
+    if metric == 'jaccard':
+        counts.data[:] = 1
+        intersection = counts.dot(counts.T).toarray()
+        sizes = np.diag(intersection)
+        union = sizes[:, None] + sizes[None, :] - intersection
+        return np.divide(intersection, union, out=np.zeros_like(intersection), where=union > 0)
+    elif metric == 'cosine':
+        dot = counts.dot(counts.T).toarray()
+        norms = np.sqrt(np.diag(dot))
+        norms = norms[:, None] * norms[None, :]
+        return np.divide(dot, norms, out=np.zeros_like(dot), where=norms > 0)
+    raise ValueError('Unknown metric: %s' % metric)
+
+@metrics.timed('similarity.max_previous_similarity')
+def max_previous_similarity(matrix):
+    """ For every document i, the highest similarity between i and the
+    documents before it (0 for the first one), i.e. the running curve of
+    Spin.plot_duplicate_evolution
+    """
+    if len(matrix) == 0:
+        return np.zeros(0)
+    return np.tril(matrix, -1).max(axis=1)
+
+###############################################################################
+# SIMILARITY INDEX
+###############################################################################
+class SimilarityIndex():
+    """ Inverted index of token sequences, giving the similarities between a
+    new sequence and every indexed one by walking only the postings of its
+    tokens. metric is either 'jaccard' (on the sets of tokens) or 'cosine' (on
+    the token counts), as for similarity_matrix()
+    """
+
+    def __init__(self, metric='jaccard'):
+        if metric not in ('jaccard', 'cosine'):
+            raise ValueError('Unknown metric: %s' % metric)
+        self.metric = metric
+        self.vocabulary = {}
+        self.norms = array('d')
+        self.postings = []  # per token id: (array of documents, array of weights)
+
+    def __len__(self):
+        return len(self.norms)
+
+    def weights(self, tokens):
+        """ Token id -> weight of a sequence, interning its new tokens
+        """
+        setdefault = self.vocabulary.setdefault
+        if self.metric == 'jaccard':
+            return dict.fromkeys((setdefault(token, len(self.vocabulary)) for token in tokens), 1)
+        return Counter(setdefault(token, len(self.vocabulary)) for token in tokens)
+
+    def norm(self, weights):
+        if self.metric == 'jaccard':
+            return float(len(weights))
+        return sqrt(sum(weight * weight for weight in weights.values()))
+
+    def similarity(self, weights1, weights2):
+        """ Similarity between two outputs of weights()
+        """
+        if len(weights1) > len(weights2):
+            weights1, weights2 = weights2, weights1
+        dot = sum(weight * weights2.get(token, 0) for token, weight in weights1.items())
+        return float(self.__similarity(dot, self.norm(weights1), self.norm(weights2)))
+
+    def __similarity(self, dot, norm1, norm2):
+        if self.metric == 'jaccard':
+            union = norm1 + norm2 - dot
+        else:
+            union = norm1 * norm2
+        return np.divide(dot, union, out=np.zeros_like(dot, dtype=np.float64), where=union > 0)
+
+    def add(self, tokens):
+        """ Index a sequence of tokens and return its position
+        """
+        position = len(self.norms)
+        weights = self.weights(tokens)
+        postings = self.postings
+        while len(postings) < len(self.vocabulary):
+            postings.append((array('q'), array('d')))
+        for token, weight in weights.items():
+            documents, document_weights = postings[token]
+            documents.append(position)
+            document_weights.append(weight)
+        self.norms.append(self.norm(weights))
+        return position
+
+    @metrics.timed('similarity.index_similarities', lambda self, tokens: len(self.norms))
+    def similarities(self, tokens):
+        """ Array of the similarities between the sequence and every indexed one
+        """
+        weights = self.weights(tokens)
+        documents, products = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for token, weight in weights.items():
+            if token < len(self.postings) and self.postings[token][0]:
+                token_documents, token_weights = self.postings[token]
+                documents.append(np.frombuffer(token_documents, dtype=np.int64))
+                products.append(weight * np.frombuffer(token_weights))
+        dot = np.bincount(np.concatenate(documents), np.concatenate(products), minlength=len(self.norms))
+        return self.__similarity(dot, self.norm(weights), np.frombuffer(self.norms))
+
+    def max_similarity(self, tokens):
+        """ Highest similarity between the sequence and the indexed ones (0 if
+        the index is empty)
+        """
+        if not self.norms:
+            return 0.0
+        return float(self.similarities(tokens).max())
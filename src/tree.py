@@ -2,71 +2,458 @@
 @author: Antonin Duroy
 '''
 
+import json
+import mmap
+import struct
+import numpy as np
+import metrics
+
+from itertools import islice
 from json.encoder import JSONEncoder
+from sys import intern
+from utils import pack_strings, unpack_strings
+
+# Binary format: header, then the int32 value/first child/child count arrays of
+# the nodes in breadth-first order (so that the children of a node are
+# contiguous), the uint8 node kinds and the string table of the values
+_MAGIC = b'SPTR'
+_VERSION = 1
+_HEADER = struct.Struct('<4sIIII')
+
+# Kinds of node
+LEAF, AND, OR = 0, 1, 2
+
+# Children of every node without any, shared to save memory
+_NO_CHILDREN = ()
 
 class SpinTree():
     """ Tree representation of a spin
+    
+    Nodes are slotted, carry a single kind tag (LEAF, AND or OR), share an
+    empty tuple as long as they have no children and intern their values, so
+    that large masterspins stay small in memory
     """
     
+    __slots__ = ('kind', 'value', 'children', '_count')
+    
     def __init__(self, or_=False, and_=False, value=None):
-        self.children = []
-        self.value = value
-        self.or_ = or_
-        self.and_ = and_
-        self.__check_parameters()
+        self.__check_parameters(or_, and_, value)
+        self.kind = OR if or_ else AND if and_ else LEAF
+        self.value = value if value is None else intern(value)
+        self.children = _NO_CHILDREN
+        self._count = None
     
-    def __check_parameters(self):
+    @staticmethod
+    def __check_parameters(or_, and_, value):
         """ Values must be set under certain conditions
         """
-        if self.or_ and self.and_:
+        if or_ and and_:
             raise ValueError('Cannot get both `AND` and `OR` conditions set to True.')
-        if not self.or_ and not self.and_ and self.value is None:
+        if not or_ and not and_ and value is None:
             raise ValueError('Value must be set.')
     
+    @property
+    def or_(self):
+        return self.kind == OR
+    
+    @property
+    def and_(self):
+        return self.kind == AND
+    
     def add_child(self, child):
-        """ Add a new branch to the current tree
+        """ Add a new branch to the current tree. In an AND node, a leaf
+        following another leaf is merged with it
+        """
+        if self.children is _NO_CHILDREN:
+            self.children = []
+        children = self.children
+        if (self.kind == AND and child.kind == LEAF and not child.children
+                and children and children[-1].kind == LEAF and not children[-1].children):
+            children[-1] = SpinTree(value=children[-1].value + child.value)
+        else:
+            children.append(child)
+        self._count = None
+    
+    def count(self):
+        """ Number of spuns the tree can produce, i.e. the number of
+        different combinations of choices (two combinations may still give the
+        same text). It is computed once, so the tree must not be modified
+        below this node afterwards
+        """
+        if self._count is None:
+            # Children come after their parent in depth-first order
+            for node, _ in reversed(list(self.__nodes())):
+                if node._count is not None:
+                    continue
+                if node.kind == OR:
+                    node._count = sum(child._count for child in node.children)
+                else:
+                    count = 1
+                    for child in node.children:
+                        count *= child._count
+                    node._count = count
+        return self._count
+    
+    def unrank(self, index):
+        """ Return the index-th spun, 0 <= index < count(). Spuns are ordered
+        by the choices of the first OR nodes first, then by branch order
+        """
+        if not 0 <= index < self.count():
+            raise IndexError('Spun index out of range.')
+        spun = []
+        stack = [(self, index)]
+        while stack:
+            node, index = stack.pop()
+            if node.value is not None:
+                spun.append(node.value)
+            if node.kind == OR:
+                for child in node.children:
+                    count = child.count()
+                    if index < count:
+                        stack.append((child, index))
+                        break
+                    index -= count
+            else:
+                # Mixed radix decomposition, the first child being the most
+                # significant, pushed last to be popped first
+                for child in reversed(node.children):
+                    index, digit = divmod(index, child.count())
+                    stack.append((child, digit))
+        return ''.join(spun)
+    
+    def iter_all(self, start=0, stop=None):
+        """ Lazily yield the spuns of indexes start to stop (excluded, all the
+        remaining ones if stop is None), in the order of unrank()
+        """
+        count = self.count()
+        stop = count if stop is None else min(stop, count)
+        if start < 0:
+            raise IndexError('Spun index out of range.')
+        # Counted by hand: islice() cannot take more than sys.maxsize items
+        remaining = stop - start
+        if remaining <= 0:
+            return
+        for spun in self.__iter_from(start):
+            yield spun
+            remaining -= 1
+            if remaining == 0:
+                return
+    
+    def __iter_from(self, index):
+        """ Odometer over the spuns of the tree, starting at the index-th one
+        """
+        value = self.value if self.value is not None else ''
+        if self.kind == OR:
+            for child in self.children:
+                count = child.count()
+                if index < count:
+                    for spun in child.__iter_from(index):
+                        yield value + spun
+                    index = 0
+                else:
+                    index -= count
+            return
+        children = self.children
+        if not children:
+            yield value
+            return
+        # Start every child at its digit of the mixed radix decomposition
+        digits = []
+        for child in reversed(children):
+            index, digit = divmod(index, child.count())
+            digits.append(digit)
+        iterators = [child.__iter_from(digit) for child, digit in zip(children, reversed(digits))]
+        current = [next(iterator) for iterator in iterators]
+        # prefixes[i] is the text of the first i children, shared between spuns
+        prefixes = [value]
+        for text in current:
+            prefixes.append(prefixes[-1] + text)
+        last = len(children) - 1
+        while True:
+            yield prefixes[-1]
+            i = last
+            while True:
+                try:
+                    current[i] = next(iterators[i])
+                    break
+                except StopIteration:
+                    if i == 0:
+                        return
+                    iterators[i] = children[i].__iter_from(0)
+                    current[i] = next(iterators[i])
+                    i -= 1
+            for j in range(i, last + 1):
+                prefixes[j+1] = prefixes[j] + current[j]
+    
+    def rank(self, text):
+        """ Return the index of the spun text, i.e. unrank(rank(text)) == text.
+        If several combinations give the same text, the lowest index is returned
+        
+        text must be a spun as made by unrank(): Spin.unspin() and the other
+        generators of Spin strip their spuns, which then cannot be ranked if
+        the masterspin starts or ends with whitespaces
+        """
+        # Dynamic programming over (node, position): matches[node, position]
+        # maps the end of every way of generating text[position:end] from the
+        # node to the lowest index giving it. Lowest indexes combine: in an AND
+        # node, the index of the first children weighs more than any of the
+        # next ones, and the branches of an OR node come in order
+        matches = {}
+        stack = [(self, 0, 0, None)]
+        while stack:
+            node, position, first, partial = stack.pop()
+            key = (id(node), position)
+            if key in matches:
+                continue
+            start = position
+            if node.value is not None:
+                if not text.startswith(node.value, position):
+                    matches[key] = {}
+                    continue
+                start += len(node.value)
+            children = node.children
+            if not children:
+                matches[key] = {start: 0}
+                continue
+            if node.kind == OR:
+                missing = [child for child in children if (id(child), start) not in matches]
+                if missing:
+                    stack.append((node, position, 0, None))
+                    stack.extend((child, start, 0, None) for child in missing)
+                    continue
+                result = {}
+                offset = 0
+                for child in children:
+                    for end, index in matches[id(child), start].items():
+                        if end not in result or offset + index < result[end]:
+                            result[end] = offset + index
+                    offset += child.count()
+                matches[key] = result
+                continue
+            # AND node: partial maps the end of the first children to their
+            # lowest index, extended one child at a time
+            if partial is None:
+                partial = {start: 0}
+            while first < len(children) and partial:
+                child = children[first]
+                missing = [end for end in partial if (id(child), end) not in matches]
+                if missing:
+                    break
+                weight = child.count()
+                extended = {}
+                for middle, prefix in partial.items():
+                    for end, index in matches[id(child), middle].items():
+                        index += prefix * weight
+                        if end not in extended or index < extended[end]:
+                            extended[end] = index
+                partial = extended
+                first += 1
+            else:
+                matches[key] = partial
+                continue
+            stack.append((node, position, first, partial))
+            stack.extend((child, end, 0, None) for end in missing)
+        index = matches[id(self), 0].get(len(text))
+        if index is None:
+            raise ValueError('The text cannot be generated from the tree.')
+        return index
+    
+    def __nodes(self):
+        """ Yield (node, depth) in depth-first order, without recursion
+        """
+        stack = [(self, 0)]
+        while stack:
+            node, depth = stack.pop()
+            yield node, depth
+            stack.extend((child, depth + 1) for child in reversed(node.children))
+    
+    def stats(self):
+        """ Number of nodes and depth of the tree, as a dict
+        """
+        nodes = 0
+        depth = 0
+        for _, node_depth in self.__nodes():
+            nodes += 1
+            depth = max(depth, node_depth)
+        return {'nodes': nodes, 'depth': depth}
+    
+    def __lines(self, depth=0):
+        """ Yield the lines of to_string()
         """
-        self.children.append(child)
+        for node, node_depth in self.__nodes():
+            if node.value is not None:
+                label = node.value
+            elif node.kind == OR:
+                label = "OR"
+            else:
+                label = "AND"
+            yield '__'*(depth+node_depth)+label if node_depth else label
     
     def to_string(self, depth=0):
         """ Convert the Spin, represented as a tree, to a printable string
         """
-        s = ""
-        if self.value is not None:
-            s += self.value
-        elif self.or_:
-            s += "OR"
-        elif self.and_:
-            s += "AND"
-        depth += 1
-        for child in self.children:
-            s += '\n'+'__'*depth+child.to_string(depth)
-        return s
+        return '\n'.join(self.__lines(depth))
+    
+    def write_text(self, fp):
+        """ Write the output of to_string() to a file-like object, line by line
+        """
+        for i, line in enumerate(self.__lines()):
+            if i:
+                fp.write('\n')
+            fp.write(line)
     
     def to_dict(self):
         """ Convert the Spin, represented as a tree, to a Python dictionary
         """
-        d = {}
-        if self.value is not None:
-            d["value"] = self.value
-        
-        if not self.children:
-            return d
-        
-        if self.or_:
-            attr_ = "or"
-        elif self.and_:
-            attr_ = "and"
-        d[attr_] = []
-        
-        for child in self.children:
-            d[attr_].append(child.to_dict())
-        return d
-        
+        root = []
+        stack = [(self, root)]
+        while stack:
+            node, siblings = stack.pop()
+            d = {}
+            if node.value is not None:
+                d["value"] = node.value
+            siblings.append(d)
+            if node.children:
+                children = d["or" if node.kind == OR else "and"] = []
+                stack.extend((child, children) for child in reversed(node.children))
+        return root[0]
+    
+    def __json_chunks(self):
+        """ Yield the output of to_json() piece by piece, without recursion
+        """
+        encode = JSONEncoder().encode
+        stack = [(self, None)]
+        while stack:
+            node, children = stack.pop()
+            if children is None:
+                # First visit of the node
+                chunks = []
+                if node.value is not None:
+                    chunks.append('"value": ' + encode(node.value))
+                if not node.children:
+                    yield '{' + ', '.join(chunks) + '}'
+                    continue
+                chunks.append('"or": [' if node.kind == OR else '"and": [')
+                yield '{' + ', '.join(chunks)
+                children = iter(node.children)
+                child = next(children)
+            else:
+                child = next(children, None)
+                if child is None:
+                    yield ']}'
+                    continue
+                yield ', '
+            stack.append((node, children))
+            stack.append((child, None))
+    
+    @metrics.timed('tree.to_json')
     def to_json(self):
         """ Convert the Spin, represented as a tree, to a JSON string
         """
-        return JSONEncoder().encode(self.to_dict())
+        return ''.join(self.__json_chunks())
+    
+    @metrics.timed('tree.dump_json')
+    def dump_json(self, fp, buffer_size=1024):
+        """ Write the output of to_json() to a file-like object, buffer_size
+        pieces at a time
+        """
+        chunks = self.__json_chunks()
+        while True:
+            buffer = ''.join(islice(chunks, buffer_size))
+            if not buffer:
+                break
+            fp.write(buffer)
+    
+    @classmethod
+    def from_dict(cls, d):
+        """ Build a tree from the output of to_dict()
+        """
+        root = cls(and_=True)
+        stack = [(d, root)]
+        while stack:
+            d, parent = stack.pop()
+            node = cls(or_='or' in d, and_='and' in d or ('or' not in d and 'value' not in d),
+                       value=d.get('value'))
+            parent.add_child(node)
+            stack.extend((child, node) for child in reversed(d.get('or', d.get('and', []))))
+        return root.children[0]
+    
+    @classmethod
+    def from_json(cls, s):
+        """ Build a tree from the output of to_json()
+        """
+        return cls.from_dict(json.loads(s))
+    
+    def to_bytes(self):
+        """ Convert the Spin, represented as a tree, to a compact binary format
+        made of a string table and flat node arrays
+        """
+        nodes = [self]
+        for node in nodes:  # Breadth-first, nodes grows while iterated
+            nodes.extend(node.children)
+        strings = {}
+        values = [-1 if node.value is None else strings.setdefault(node.value, len(strings))
+                  for node in nodes]
+        child_count = [len(node.children) for node in nodes]
+        first_child = np.cumsum([1] + child_count[:-1])
+        kinds = [node.kind for node in nodes]
+        offsets, blob = pack_strings(list(strings))
+        return b''.join([_HEADER.pack(_MAGIC, _VERSION, len(nodes), len(strings), len(blob)),
+                         np.array(values, dtype=np.int32).tobytes(),
+                         first_child.astype(np.int32).tobytes(),
+                         np.array(child_count, dtype=np.int32).tobytes(),
+                         np.array(kinds, dtype=np.uint8).tobytes(), offsets, blob])
+    
+    @classmethod
+    def from_bytes(cls, data):
+        """ Build a tree from the output of to_bytes(), data being any buffer
+        (bytes, memory map...)
+        """
+        if len(data) < _HEADER.size:
+            raise ValueError('Not a spin tree in a supported binary format.')
+        magic, version, n_nodes, n_strings, blob_size = _HEADER.unpack_from(data, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('Not a spin tree in a supported binary format.')
+        # Three int32 and one uint8 arrays, then the string table
+        if len(data) != _HEADER.size + 13 * n_nodes + 4 * (n_strings + 1) + blob_size:
+            raise ValueError('Truncated or damaged spin tree.')
+        position = _HEADER.size
+        arrays = []
+        for dtype in (np.int32, np.int32, np.int32, np.uint8):
+            arrays.append(np.frombuffer(data, dtype=dtype, count=n_nodes, offset=position).tolist())
+            position += n_nodes * np.dtype(dtype).itemsize
+        values, first_child, child_count, kinds = arrays
+        strings = [intern(string) for string in unpack_strings(data, position, n_strings, blob_size)]
+        strings.append(None)  # values[i] == -1
+        # The nodes are filled in directly, the format being checked already
+        new = cls.__new__
+        nodes = []
+        append = nodes.append
+        for kind, value in zip(kinds, values):
+            node = new(cls)
+            node.kind = kind
+            node.value = strings[value]
+            node.children = _NO_CHILDREN
+            node._count = None
+            append(node)
+        for node, first, count in zip(nodes, first_child, child_count):
+            if count:
+                node.children = nodes[first:first + count]
+        return nodes[0]
+    
+    def save(self, path):
+        """ Save the tree to a file in the binary format of to_bytes()
+        """
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+    
+    @classmethod
+    def load(cls, path):
+        """ Load a tree saved by save(), through a memory map of the file
+        """
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return cls.from_bytes(data)
     
     def __repr__(self):
         return self.to_string()
\ No newline at end of file
@@ -3,23 +3,59 @@ Created on 16 oct. 2015
 
 @author: Antonin Duroy
 '''
-from collections import OrderedDict
+import random
+import numpy as np
 
-def insert_at_position(iterable, position, new_item):
-    """ Insert an item at a certain position in a Python OrderedDict and return
-    a new OrderedDict
+from hashlib import sha256
+
+def permuted_range(size, seed=None, rounds=4):
+    """ Yield every integer of range(size) exactly once, in a pseudo-random order
+    given by the seed, without storing them (format-preserving shuffle: a
+    Feistel network over the smallest even number of bits holding size, with
+    cycle walking to stay below size)
+    """
+    if seed is None:
+        seed = random.SystemRandom().getrandbits(64)
+    half = max(1, ((size - 1).bit_length() + 1) // 2)
+    mask = (1 << half) - 1
+    keys = [('%s:%d:' % (seed, r)).encode('utf-8') for r in range(rounds)]
+    blocks = (half + 255) // 256
+    
+    def round_function(key, value):
+        data = key + str(value).encode('ascii')
+        digest = b''.join(sha256(data + bytes([i])).digest() for i in range(blocks))
+        return int.from_bytes(digest, 'big') & mask
+    
+    def encrypt(value):
+        left, right = value >> half, value & mask
+        for key in keys:
+            left, right = right, left ^ round_function(key, right)
+        return (left << half) | right
+    
+    for i in range(size):
+        value = encrypt(i)
+        while value >= size:
+            value = encrypt(value)
+        yield value
+
+def pack_strings(strings):
+    """ Encode a list of strings as a string table: the uint32 offsets of the
+    strings in the UTF-8 blob, and the blob itself
+    """
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+    offsets[1:] = np.cumsum([len(string) for string in encoded])
+    return offsets.tobytes(), b''.join(encoded)
+
+def unpack_strings(data, position, n_strings, blob_size):
+    """ Decode the n_strings strings of a table packed with pack_strings() and
+    stored in data (any buffer) at position
     """
-    if len(new_item) != 2:
-        raise ValueError('new_item must be of length 2.')
-    items = []
-    inserted = False
-    for i, item in enumerate(iterable.items()):
-        if i != position:
-            items.append(item)
-        else:
-            items.append(new_item)
-            items.append(item)
-            inserted = True
-    if not inserted:
-        items.append(new_item)
-    return OrderedDict(items)
+    offsets = np.frombuffer(data, dtype=np.uint32, count=n_strings + 1, offset=position).tolist()
+    position += 4 * (n_strings + 1)
+    raw = bytes(data[position:position + blob_size])
+    blob = raw.decode('utf-8')
+    if len(blob) == blob_size:
+        # Pure ASCII, byte offsets are character offsets too
+        return [blob[offsets[i]:offsets[i+1]] for i in range(n_strings)]
+    return [raw[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(n_strings)]
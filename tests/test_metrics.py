@@ -0,0 +1,102 @@
+'''
+@author: Antonin Duroy
+'''
+import io
+import unittest
+import metrics
+from spin import Spin
+from text_similarity import similarity_matrix, jaccard_similarity
+
+MASTERSPIN = "{My name is|I{ am|'m}} John Doe and I {truly|really} love the {spintax|spin framework}{.|!}"
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        metrics.reset()
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.reset()
+
+    def test_disabled(self):
+        metrics.disable()
+        Spin(MASTERSPIN).unspin()
+        jaccard_similarity('a b'.split(), 'b c'.split())
+        self.assertEqual(metrics.snapshot(), {'counters': {}, 'histograms': {}})
+
+    def test_snapshot(self):
+        spin = Spin(MASTERSPIN)
+        spun = spin.unspin()
+        spuns = spin.unspin_many(10, seed=1)
+        spin.build_tree().to_json()
+        similarity_matrix(spuns)
+        jaccard_similarity(spun.split(), spuns[0].split())
+
+        snapshot = metrics.snapshot()
+        counters = snapshot['counters']
+        self.assertEqual(counters['spin.spuns'], 11)
+        self.assertEqual(counters['spin.generated_bytes'],
+                         sum(len(spun.encode('utf-8')) for spun in [spun] + spuns))
+        self.assertEqual(counters['similarity.comparisons'], 101)
+        histograms = snapshot['histograms']
+        for name in ('spin.unspin', 'spin.unspin_many', 'program.compile', 'spin.build_tree',
+                     'spin.parse_tree', 'tree.to_json', 'similarity.similarity_matrix',
+                     'similarity.jaccard_similarity'):
+            self.assertEqual(histograms[name + '.seconds']['count'], 1, name)
+        self.assertEqual(histograms['tree.depth']['sum'], 4)
+        self.assertEqual(histograms['tree.nodes']['sum'], len(list(spin.build_tree().to_string().splitlines())))
+        buckets = histograms['spin.unspin.seconds']['buckets']
+        self.assertEqual(buckets[float('inf')], 1)
+
+    def test_prometheus(self):
+        Spin(MASTERSPIN).unspin()
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE spin_spin_spuns_total counter\nspin_spin_spuns_total 1\n', text)
+        self.assertIn('# TYPE spin_spin_unspin_seconds histogram', text)
+        self.assertIn('spin_spin_unspin_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn('spin_spin_unspin_seconds_count 1', text)
+
+    def test_hooks(self):
+        metrics.disable()
+        calls = []
+        with metrics.hook(lambda name, seconds: calls.append(name)):
+            Spin(MASTERSPIN).unspin()
+        Spin(MASTERSPIN).unspin()
+        self.assertEqual(calls, ['program.compile', 'spin.unspin'])
+        self.assertFalse(metrics.is_enabled())
+        
+        # Nested hooks, the outer one left last or first
+        calls1, calls2 = [], []
+        hook1 = metrics.hook(lambda name, seconds: calls1.append(name))
+        hook2 = metrics.hook(lambda name, seconds: calls2.append(name))
+        with hook1:
+            with hook2:
+                Spin(MASTERSPIN).unspin()
+            Spin(MASTERSPIN).unspin()
+        self.assertEqual(len(calls1), 4)
+        self.assertEqual(len(calls2), 2)
+        self.assertFalse(metrics.is_enabled())
+        calls1, calls2 = [], []
+        hook1.__enter__()
+        hook2.__enter__()
+        hook1.__exit__(None, None, None)
+        Spin(MASTERSPIN).unspin()
+        self.assertTrue(metrics.is_enabled())
+        hook2.__exit__(None, None, None)
+        self.assertEqual((calls1, calls2), ([], ['program.compile', 'spin.unspin']))
+        self.assertFalse(metrics.is_enabled())
+        metrics.enable()
+        with hook1:
+            pass
+        self.assertTrue(metrics.is_enabled())
+        metrics.disable()
+
+        stream = io.StringIO()
+        with metrics.profile(stream=stream, limit=5):
+            Spin(MASTERSPIN).unspin_many(100)
+        self.assertIn('function calls', stream.getvalue())
+
+if __name__ == "__main__":
+    unittest.main()
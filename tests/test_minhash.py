@@ -0,0 +1,58 @@
+'''
+@author: Antonin Duroy
+'''
+import os
+import tempfile
+import unittest
+from minhash import MinHashLSH, shingles
+from spin import Spin
+from text_similarity import jaccard_similarity
+
+class Test(unittest.TestCase):
+
+
+    def setUp(self):
+        masterspin = ' '.join(['{the|a|one} {quick|fast|rapid} {brown|red} {fox|dog} {jumps|leaps}'] * 6)
+        self.spuns = Spin(masterspin).unspin_many(60, seed=3)
+        self.index = MinHashLSH()
+        for spun in self.spuns[:-1]:
+            self.index.add(spun)
+    
+    def test_estimates(self):
+        spun = self.spuns[-1]
+        signature = self.index.signature(spun)
+        for key, other in enumerate(self.spuns[:-1]):
+            exact = jaccard_similarity(shingles(spun), shingles(other))
+            estimate = (signature == self.index.signatures[key]).mean()
+            self.assertAlmostEqual(estimate, exact, delta=0.15)
+    
+    def test_query(self):
+        self.assertEqual(self.index.query(self.spuns[5], 0.9)[0], (5, 1.0))
+        for key, estimate in self.index.query(self.spuns[-1], 0.3):
+            self.assertGreaterEqual(estimate, 0.3)
+        self.assertEqual(self.index.query('nothing in common here', 0.1), [])
+    
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index.npz')
+            self.index.save(path)
+            index = MinHashLSH.load(path)
+            self.assertEqual(len(index), len(self.index))
+            self.assertEqual(index.query(self.spuns[-1], 0.3), self.index.query(self.spuns[-1], 0.3))
+    
+    def test_save_load_unseeded(self):
+        index = MinHashLSH(num_perm=32, bands=8, seed=None)
+        for spun in self.spuns[:20]:
+            index.add(spun)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'index')
+            index.save(path)
+            self.assertEqual(os.listdir(directory), ['index'])
+            loaded = MinHashLSH.load(path)
+        self.assertEqual(loaded.seed, index.seed)
+        self.assertEqual(loaded.signature(self.spuns[3]).tolist(), index.signature(self.spuns[3]).tolist())
+        self.assertEqual(loaded.query(self.spuns[3], 0.3), index.query(self.spuns[3], 0.3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+'''
+@author: Antonin Duroy
+'''
+import json
+import asyncio
+import unittest
+from spin import Spin
+from service import SpinService
+
+MASTERSPIN = "{My name is|I{ am|'m}} John Doe and I {truly|really} love the {spintax|spin framework}{.|!}"
+
+async def request(reader, writer, **message):
+    writer.write(json.dumps(message).encode('utf-8') + b'\n')
+    await writer.drain()
+    return json.loads(await reader.readline())
+
+class Test(unittest.TestCase):
+
+
+    def run_service(self, client, limit=1 << 24, **options):
+        """ Run client(service, port) against a service listening on loopback
+        """
+        async def main():
+            service = SpinService(**options)
+            server = await service.start('127.0.0.1', 0, limit)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                return await client(service, port)
+            finally:
+                server.close()
+                await server.wait_closed()
+        return asyncio.run(main())
+
+    def test_unspin(self):
+        async def client(service, port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            loaded = await request(reader, writer, op='load', masterspin=MASTERSPIN, id=1)
+            seeded = await request(reader, writer, op='unspin', hash=loaded['hash'], n=5, seed=3, id=2)
+            unseeded = await request(reader, writer, op='unspin', masterspin=MASTERSPIN, n=3)
+            error = await request(reader, writer, op='unspin', hash='unknown', id=4)
+            writer.close()
+            return loaded, seeded, unseeded, error, len(service.spins)
+
+        loaded, seeded, unseeded, error, cached = self.run_service(client)
+        self.assertEqual(loaded['id'], 1)
+        self.assertEqual(seeded, {'id': 2, 'spuns': Spin(MASTERSPIN).unspin_many(5, seed=3)})
+        spuns = list(Spin(MASTERSPIN).enumerate())
+        self.assertEqual(len(unseeded['spuns']), 3)
+        self.assertTrue(all(spun in spuns for spun in unseeded['spuns']))
+        self.assertEqual(error['id'], 4)
+        self.assertIn('error', error)
+        self.assertEqual(cached, 1)
+
+    def test_batching(self):
+        async def client(service, port):
+            connections = [await asyncio.open_connection('127.0.0.1', port) for _ in range(20)]
+            responses = await asyncio.gather(*[request(reader, writer, op='unspin', masterspin=MASTERSPIN, n=2)
+                                               for reader, writer in connections])
+            for _, writer in connections:
+                writer.close()
+            return responses, service.generations
+
+        responses, generations = self.run_service(client)
+        self.assertTrue(all(len(response['spuns']) == 2 for response in responses))
+        self.assertLess(generations, 20)
+
+    def test_pipelining(self):
+        async def client(service, port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            for i in range(10):
+                message = {'op': 'unspin', 'masterspin': MASTERSPIN, 'n': 1, 'id': i}
+                writer.write(json.dumps(message).encode('utf-8') + b'\n')
+            message = {'op': 'similarity', 'query': 'a b c', 'documents': ['a b', 'c d', 'e'], 'id': 'sim'}
+            writer.write(json.dumps(message).encode('utf-8') + b'\n')
+            writer.write_eof()
+            responses = [json.loads(line) async for line in reader]
+            writer.close()
+            return responses, service.generations
+
+        responses, generations = self.run_service(client, cache_size=1)
+        self.assertEqual(sorted(str(response['id']) for response in responses),
+                         sorted([str(i) for i in range(10)] + ['sim']))
+        similarities = [response for response in responses if response['id'] == 'sim'][0]
+        self.assertEqual(similarities['similarities'], [2 / 3, 1 / 4, 0.0])
+        self.assertEqual(generations, 1)
+
+    def test_malformed_requests(self):
+        async def client(service, port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            responses = []
+            for line in (b'[1, 2]', b'"str"', b'{"op": "similarity", "query": "a", "documents": [1]}',
+                         b'{"op": "unspin", "masterspin": "{a|b}", "n": 10000000000}', b'not json'):
+                writer.write(line + b'\n')
+                await writer.drain()
+                responses.append(json.loads(await asyncio.wait_for(reader.readline(), 5)))
+            writer.close()
+            return responses
+
+        responses = self.run_service(client)
+        self.assertEqual(len(responses), 5)
+        self.assertTrue(all('error' in response for response in responses))
+
+    def test_line_too_long(self):
+        async def client(service, port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'{"op": "stats", "id": 1}\n')
+            writer.write(b'{"op": "stats", "id": "' + b'x' * 5000 + b'"}\n')
+            writer.write(b'{"op": "stats", "id": 2}\n')
+            writer.write(b'x' * 3000)  # Unterminated, up to the end of the connection
+            writer.write_eof()
+            data = await asyncio.wait_for(reader.read(), 5)
+            responses = [json.loads(line) for line in data.splitlines()]
+            writer.close()
+            return responses
+
+        responses = self.run_service(client, limit=1000)
+        self.assertEqual(len(responses), 4)
+        self.assertEqual(sorted(response['id'] for response in responses if 'id' in response), [1, 2])
+        self.assertEqual(sum('error' in response for response in responses), 2)
+
+    def test_failed_batch(self):
+        async def client(service, port):
+            service.rng = None  # makes the batched generation fail
+            connections = [await asyncio.open_connection('127.0.0.1', port) for _ in range(5)]
+            responses = await asyncio.wait_for(asyncio.gather(
+                *[request(reader, writer, op='unspin', masterspin=MASTERSPIN)
+                  for reader, writer in connections]), 5)
+            for _, writer in connections:
+                writer.close()
+            return responses
+
+        responses = self.run_service(client)
+        self.assertTrue(all('error' in response for response in responses))
+
+    def test_lru(self):
+        service = SpinService(cache_size=2)
+        keys = [service.load(masterspin) for masterspin in ('{a|b}', '{c|d}', '{a|b}', '{e|f}')]
+        self.assertEqual(keys[0], keys[2])
+        self.assertEqual(list(service.spins), [keys[0], keys[3]])
+        self.assertRaises(ValueError, service.get, keys[1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+'''
+@author: Antonin Duroy
+'''
+import random
+import unittest
+import numpy as np
+from text_similarity import (jaro_winkler_similarity, jaro_winkler_many, intern_tokens,
+                             levenshtein_distance, levenshtein_similarity,
+                             _myers_levenshtein_distance, _banded_levenshtein_distance,
+                             minkowski_distance, minkowski_distances, manhattan_distance,
+                             euclidean_distance, count_matrix, _same_width)
+
+def reference_levenshtein(seq1, seq2):
+    """ Plain two-row dynamic programming
+    """
+    previous = list(range(len(seq2) + 1))
+    for i, token in enumerate(seq1, 1):
+        current = [i]
+        for j in range(1, len(seq2) + 1):
+            current.append(min(previous[j] + 1, current[j-1] + 1,
+                               previous[j-1] + (seq2[j-1] != token)))
+        previous = current
+    return previous[-1]
+
+class Test(unittest.TestCase):
+
+
+    def test_jaro_winkler(self):
+        self.assertAlmostEqual(jaro_winkler_similarity('MARTHA', 'MARHTA'), 0.9611, places=4)
+        self.assertAlmostEqual(jaro_winkler_similarity('DWAYNE', 'DUANE', prefix_len=4), 0.84, places=4)
+        self.assertAlmostEqual(jaro_winkler_similarity('DIXON', 'DICKSONX', prefix_len=4), 0.8133, places=4)
+        self.assertEqual(jaro_winkler_similarity('abc', 'abc'), 1.0)
+        self.assertEqual(jaro_winkler_similarity('abc', 'xyz'), 0.0)
+        self.assertEqual(jaro_winkler_similarity('', ''), 1.0)
+        self.assertEqual(jaro_winkler_similarity('', 'abc'), 0.0)
+        self.assertEqual(jaro_winkler_similarity('abc', []), 0.0)
+    
+    def test_jaro_winkler_many(self):
+        docs = ['MARTHA', 'MARHTA', 'DWAYNE', 'DUANE', 'DIXON', 'DICKSONX', '', 'A', 'AAAAAA', 'HTRAMA']
+        ids, _ = intern_tokens(list(doc) for doc in docs)
+        for query in ids:
+            for prefix_len in (3, 4):
+                expected = [jaro_winkler_similarity(query, candidate, prefix_len) for candidate in ids]
+                similarities = jaro_winkler_many(np.array(query), ids, prefix_len)
+                self.assertEqual(similarities.shape, (len(ids),))
+                self.assertTrue(np.allclose(similarities, expected))
+        self.assertEqual(len(jaro_winkler_many(ids[0], [])), 0)
+    
+    def test_levenshtein(self):
+        rng = random.Random(5)
+        pairs = [('', ''), ('', 'abc'), ('abc', ''), ('kitten', 'sitting'), ('flaw', 'lawn')]
+        pairs += [([rng.randint(0, 3) for _ in range(rng.randint(0, 30))],
+                   [rng.randint(0, 3) for _ in range(rng.randint(0, 30))]) for _ in range(300)]
+        # Long enough for the bit vectors to span several machine words
+        pairs += [([rng.randint(0, 9) for _ in range(200)], [rng.randint(0, 9) for _ in range(150)])
+                  for _ in range(5)]
+        for seq1, seq2 in pairs:
+            d = reference_levenshtein(seq1, seq2)
+            self.assertEqual(_myers_levenshtein_distance(seq1, seq2), d)
+            self.assertEqual(levenshtein_distance(seq1, seq2), d)
+            for k in {0, d - 1, d, d + 1, 2 * d + 20}:
+                if k < 0:
+                    continue
+                expected = d if d <= k else k + 1
+                self.assertEqual(_banded_levenshtein_distance(seq1, seq2, k), expected, (seq1, seq2, k))
+                self.assertEqual(levenshtein_distance(seq1, seq2, k), expected, (seq1, seq2, k))
+        self.assertEqual(levenshtein_distance('kitten', 'sitting', 3), 3)
+        self.assertEqual(levenshtein_distance('kitten', 'sitting', 2), 3)
+        self.assertEqual(levenshtein_distance('', '', 0), 0)
+        self.assertEqual(levenshtein_distance('', 'abc', 1), 2)
+    
+    def test_levenshtein_similarity(self):
+        self.assertEqual(levenshtein_similarity('', ''), 1.0)
+        self.assertAlmostEqual(levenshtein_similarity('kitten', 'sitting'), 1 - 3 / 7)
+        self.assertAlmostEqual(levenshtein_similarity('kitten', 'sitting', threshold=1 - 3 / 7), 1 - 3 / 7)
+        self.assertEqual(levenshtein_similarity('kitten', 'sitting', threshold=1 - 2 / 7), 0.0)
+    
+    def test_minkowski(self):
+        # Counts: a 3/0, b 1/1, c 0/1, so differences 3, 0 and 1
+        seq1, seq2 = 'a a a b'.split(), 'b c'.split()
+        self.assertAlmostEqual(minkowski_distance(seq1, seq2, 1), 4)
+        self.assertAlmostEqual(minkowski_distance(seq1, seq2, 2), 10 ** 0.5)
+        self.assertAlmostEqual(minkowski_distance(seq1, seq2, 3), 28 ** (1 / 3))
+        self.assertAlmostEqual(manhattan_distance(seq1, seq2), 4)
+        self.assertAlmostEqual(euclidean_distance(seq1, seq2), 10 ** 0.5)
+        self.assertEqual(minkowski_distance(seq1, seq1, 3), 0)
+    
+    def test_same_width(self):
+        # The second matrix is built once the vocabulary has grown by 'c'
+        counts1, vocabulary = count_matrix(['a b'.split(), 'a a'.split()])
+        counts2, vocabulary = count_matrix(['c a'.split()], vocabulary)
+        self.assertEqual((counts1.shape, counts2.shape), ((2, 2), (1, 3)))
+        padded1, padded2 = _same_width(counts1, counts2)
+        self.assertEqual((padded1.shape, padded2.shape), ((2, 3), (1, 3)))
+        self.assertEqual(padded1.toarray().tolist(), [[1, 1, 0], [2, 0, 0]])
+        self.assertIs(padded2, counts2)
+        self.assertEqual([matrix.shape for matrix in _same_width(counts2, counts1)], [(1, 3), (2, 3)])
+        for p, expected in ((1, [2, 2]), (2, [2 ** 0.5, 2 ** 0.5]), (3, [2 ** (1 / 3), 2 ** (1 / 3)])):
+            self.assertTrue(np.allclose(minkowski_distances(counts1, counts2, p).ravel(), expected))
+            self.assertTrue(np.allclose(minkowski_distances(counts2, counts1, p).ravel(), expected))
+
+if __name__ == "__main__":
+    unittest.main()
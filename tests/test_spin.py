@@ -1,8 +1,13 @@
 '''
 @author: Antonin Duroy
 '''
+import io
+import os
+import tempfile
 import unittest
 from spin import Spin
+from text_similarity import similarity_matrix, max_previous_similarity
+from spintax import SpinSyntaxError
 
 class Test(unittest.TestCase):
 
@@ -21,6 +26,163 @@ class Test(unittest.TestCase):
         
         spin = Spin(masterspin)
         self.assertTrue(spin.unspin() in spuns)
+    
+    def test_unspin_unbalanced_braces(self):
+        spin = Spin('} {a|{b}')
+        self.assertEqual(spin.unspin(), '} {a|b')
+        
+        spin = Spin('{a||b}')
+        self.assertTrue(spin.unspin() in ['a', '', 'b'])
+    
+    def test_unspin_many(self):
+        spin = Spin('Result: {a|{b|c}} {{d|e}|f}')
+        spuns = spin.unspin_many(200, seed=42)
+        self.assertEqual(len(spuns), 200)
+        self.assertEqual(spuns, spin.unspin_many(200, seed=42))
+        self.assertEqual(spuns, list(spin.iter_unspin(200, seed=42, batch_size=64)))
+        self.assertEqual(len(set(spuns)), 9)
+        
+        self.assertEqual(Spin('no choice').unspin_many(3), ['no choice'] * 3)
+    
+    def test_generate_parallel(self):
+        spin = Spin('Result: {a|{b|c}} {{d|e}|f} {g|h|i|j}')
+        spuns = list(spin.generate_parallel(250, workers=1, seed=5, chunk_size=40))
+        self.assertEqual(len(spuns), 250)
+        self.assertEqual(spuns, list(spin.generate_parallel(250, workers=3, seed=5, chunk_size=40)))
+        self.assertEqual(sorted(spuns),
+                         sorted(spin.generate_parallel(250, workers=2, seed=5, chunk_size=40, ordered=False)))
+    
+    def test_unique_spuns(self):
+        spin = Spin('Result: {a|{b|c}} {{d|e}|f}')
+        spuns = list(spin.unique_spuns(seed=7))
+        self.assertEqual(len(spuns), 9)
+        self.assertEqual(len(set(spuns)), 9)
+        self.assertEqual(spuns, list(spin.unique_spuns(seed=7)))
+        self.assertEqual(spuns[:4], list(spin.unique_spuns(4, seed=7)))
+        self.assertEqual(len(list(spin.unique_spuns(100))), 9)
+        
+        # Ambiguous masterspins, several combinations giving the same text
+        spin = Spin('{a|a} {b| b}')
+        self.assertEqual(sorted(spin.unique_spuns(seed=1)), ['a  b', 'a b'])
+        self.assertEqual(len(list(spin.unique_spuns(1, seed=1))), 1)
+        self.assertEqual(list(spin.unique_spuns(0)), [])
+        spuns = list(Spin('{a|ab}{b|}').unique_spuns(seed=1))
+        self.assertEqual(sorted(spuns), ['a', 'ab', 'abb'])
+    
+    def test_diverse_spuns(self):
+        spin = Spin('{a|b} {c|d}')
+        spuns = list(spin.diverse_spuns(4, seed=3))
+        self.assertEqual(len(set(spuns)), 4)
+        self.assertFalse(set(spuns[0].split()) & set(spuns[1].split()))
+        self.assertEqual(spuns, list(spin.diverse_spuns(4, seed=3)))
+        self.assertEqual(len(list(spin.diverse_spuns(6, metric='cosine'))), 6)
+    
+    def test_evaluate_duplicates(self):
+        spin = Spin('{a|b|c} {d|e} {f|g|h}')
+        evaluator = spin.evaluate_duplicates(40, seed=2, measures=('jaccard', 'jaro_winkler', 'cosine'))
+        spuns = spin.unspin_many(40, seed=2)
+        for metric in ('jaccard', 'cosine'):
+            expected = max_previous_similarity(similarity_matrix(spuns, metric))
+            self.assertEqual([round(value, 9) for value in evaluator.curves[metric]],
+                             [round(value, 9) for value in expected])
+        self.assertEqual(evaluator.curve_array().shape, (40, 3))
+        
+        with tempfile.TemporaryDirectory() as directory:
+            spin.evaluate_duplicates(25, directory, checkpoint_every=10, seed=2)
+            resumed = spin.evaluate_duplicates(40, directory, checkpoint_every=10)
+            self.assertEqual(resumed.curves, spin.evaluate_duplicates(40, seed=2).curves)
+            with open(os.path.join(directory, 'curves.csv')) as f:
+                self.assertEqual(len(f.readlines()), 41)
+        
+        with tempfile.TemporaryDirectory() as directory:
+            # Spuns of an evaluation interrupted before its first state was saved
+            with open(os.path.join(directory, 'spuns.jsonl'), 'w') as f:
+                f.write('"stale"\n' * 5)
+            spin.evaluate_duplicates(25, directory, checkpoint_every=10, seed=2)
+            resumed = spin.evaluate_duplicates(40, directory, checkpoint_every=10)
+            self.assertEqual(resumed.curves, spin.evaluate_duplicates(40, seed=2).curves)
+            with open(os.path.join(directory, 'spuns.jsonl')) as f:
+                self.assertEqual(f.read().splitlines(), ['"%s"' % spun for spun in spin.unspin_many(40, seed=2)])
+    
+    def test_choice_similarity(self):
+        spin = Spin('{a b|{c|d e} f} x {g|{h|a}|} {b|c d}')
+        text, choices = spin.unspin(with_choices=True)
+        self.assertEqual(len(choices), 5)
+        self.assertIn(text, list(spin.enumerate()))
+        
+        spin = Spin('{a b|{c|d e} f} x {g|h}')
+        similarity = spin.choice_similarity()
+        self.assertEqual(similarity.program.trace([0, 1, 1]), [0, -1, 1])
+        profile1 = similarity.profile([0, 1, 0])  # a b x g
+        profile2 = similarity.profile([1, 1, 0])  # d e f x g
+        self.assertEqual(similarity.jaccard(profile1, profile2), 2 / 7)
+        self.assertAlmostEqual(similarity.cosine(profile1, profile2), 2 / (4 * 5) ** 0.5)
+        self.assertEqual(similarity.jaccard(profile1, similarity.profile([0, 0, 0])), 1.0)
+        
+        spuns = spin.unspin_many(20, seed=4, with_choices=True)
+        self.assertEqual([spun for spun, _ in spuns], spin.unspin_many(20, seed=4))
+        matrix = similarity_matrix([spun for spun, _ in spuns], 'cosine')
+        profiles = [similarity.profile(choices) for _, choices in spuns]
+        for i in range(20):
+            for j in range(20):
+                self.assertAlmostEqual(similarity.cosine(profiles[i], profiles[j]), matrix[i, j])
+    
+    def test_enumerate(self):
+        spin = Spin('{a|b} {c|d}')
+        self.assertEqual(list(spin.enumerate()), ['a c', 'a d', 'b c', 'b d'])
+        self.assertEqual(list(spin.enumerate(1, 3)), ['a d', 'b c'])
+    
+    def test_iter_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'masterspins.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('First {a|b\n{c|d}}\nSecond {e|f}\n\nThird\n')
+            for buffer_size in (1, 2, 5, 1 << 20):
+                spins = list(Spin.iter_file(path, buffer_size=buffer_size))
+                self.assertEqual([spin.masterspin for spin in spins],
+                                 ['First {a|b\n{c|d}}', 'Second {e|f}', 'Third'])
+            
+            fp = io.StringIO()
+            spins[1].write_spuns(fp, 3, seed=1)
+            self.assertEqual(fp.getvalue(), '\n'.join(spins[1].unspin_many(3, seed=1)) + '\n')
+            
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('Price {a|b} {oops\nSecond {c|d}\nThird\n')
+            for buffer_size in (1, 5, 1 << 20):
+                with self.assertRaises(SpinSyntaxError) as context:
+                    list(Spin.iter_file(path, buffer_size=buffer_size))
+                self.assertEqual(context.exception.position, 12)
+                with self.assertRaises(SpinSyntaxError) as context:
+                    list(Spin.iter_file(path, buffer_size=buffer_size, max_record_size=10))
+                self.assertEqual(context.exception.position, 12)
+            
+            with open(path, 'wb') as f:
+                f.write(b'First {a|b\n}\r\nSecond {c|d}\r\n')
+            for buffer_size in (1, 2, 1 << 20):
+                spins = list(Spin.iter_file(path, separator='\r\n', buffer_size=buffer_size))
+                self.assertEqual([spin.masterspin for spin in spins], ['First {a|b\n}', 'Second {c|d}'])
+            spins = list(Spin.iter_file(path))
+            self.assertEqual([spin.masterspin for spin in spins], ['First {a|b\n}', 'Second {c|d}'])
+    
+    def test_build_tree(self):
+        spin = Spin("{My name is|I{ am|'m}} John Doe{.|!}")
+        self.assertEqual(spin.build_tree().to_json(),
+                         '{"and": [{"or": [{"value": "My name is"}, {"and": [{"value": "I"}, '
+                         '{"or": [{"value": " am"}, {"value": "\'m"}]}]}]}, '
+                         '{"value": " John Doe"}, {"or": [{"value": "."}, {"value": "!"}]}]}')
+        
+        spin = Spin('__NODE__1 {a|}')
+        self.assertEqual(spin.build_tree().to_json(),
+                         '{"and": [{"value": "__NODE__1 "}, {"or": [{"value": "a"}, {"value": ""}]}]}')
+    
+    def test_build_tree_unbalanced_braces(self):
+        with self.assertRaises(SpinSyntaxError) as context:
+            Spin('{a|b} {c|{d}').build_tree()
+        self.assertEqual(context.exception.position, 6)
+        
+        with self.assertRaises(SpinSyntaxError) as context:
+            Spin('{a|b}} c').build_tree()
+        self.assertEqual(context.exception.position, 5)
 
 
 if __name__ == "__main__":
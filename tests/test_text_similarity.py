@@ -63,6 +63,8 @@ print('dkjsqndksjqbdjkqs')
 print('dksqndknsqkdjbsbdhagvdagz')
 print(levenshtein_distance("dkjsqndksjqbdjkqs", "dksqndknsqkdjbsbdhagvdagz"))
 print(levenshtein_similarity("dkjsqndksjqbdjkqs", "dksqndknsqkdjbsbdhagvdagz"))
+print(levenshtein_distance("dkjsqndksjqbdjkqs", "dksqndknsqkdjbsbdhagvdagz", 5))
+print(levenshtein_similarity("dkjsqndksjqbdjkqs", "dksqndknsqkdjbsbdhagvdagz", 0.8))
 
 ###############################################################################
 # MINKOWSKI DISTANCE
@@ -94,4 +96,44 @@ print(manhattan_distance(word_tokenize(s1, 'french'), word_tokenize(s2, 'french'
 print('\n=== EUCLIDEAN DISTANCE BETWEEN ===')
 print(s1)
 print(s2)
-print(euclidean_distance(word_tokenize(s1, 'french'), word_tokenize(s2, 'french')))
\ No newline at end of file
+print(euclidean_distance(word_tokenize(s1, 'french'), word_tokenize(s2, 'french')))
+###############################################################################
+# SIMILARITY MATRIX
+###############################################################################
+print('\n=== SIMILARITY MATRICES BETWEEN ===')
+for doc in documents:
+    print(doc)
+print(similarity_matrix(documents, 'jaccard'))
+print(similarity_matrix(documents, 'cosine'))
+print(max_previous_similarity(similarity_matrix(documents, 'jaccard')))
+
+###############################################################################
+# JARO WINKLER SIMILARITY (BATCH)
+###############################################################################
+print('\n=== JARO-WINKLER SIMILARITIES BETWEEN ===')
+print(documents[0])
+for doc in documents:
+    print(doc)
+interned_docs, _ = intern_tokens(doc.split() for doc in documents)
+print(jaro_winkler_many(interned_docs[0], interned_docs))
+
+###############################################################################
+# DISTANCE MATRICES
+###############################################################################
+print('\n=== DISTANCE MATRICES BETWEEN ===')
+for doc in documents:
+    print(doc)
+counts, vocabulary = count_matrix(doc.split() for doc in documents)
+print(minkowski_distances(counts, p=3))
+print(manhattan_distances(counts[0], counts))
+print(euclidean_distances(counts))
+
+###############################################################################
+# SIMILARITY INDEX
+###############################################################################
+print('\n=== SIMILARITY INDEX (JACCARD) OF ===')
+index = SimilarityIndex('jaccard')
+for doc in documents:
+    print(doc)
+    print(index.similarities(doc.split()))
+    index.add(doc.split())
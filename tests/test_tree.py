@@ -0,0 +1,195 @@
+'''
+@author: Antonin Duroy
+'''
+import io
+import os
+import tempfile
+import unittest
+from itertools import islice
+from spin import Spin
+from tree import SpinTree
+from program import SpinProgram
+from analysis import diversity_report
+
+class Test(unittest.TestCase):
+
+
+    def test_count(self):
+        tree = Spin('Result: {a|{b|c}} {{d|e}|f}').build_tree()
+        self.assertEqual(tree.count(), 9)
+        
+        tree = Spin(' '.join(['{a|b|c|{d|e}}'] * 60)).build_tree()
+        self.assertEqual(tree.count(), 5 ** 60)
+    
+    def test_unrank_rank(self):
+        tree = Spin('Result: {a|{b|c}} {{d|e}|f}').build_tree()
+        spuns = [tree.unrank(i) for i in range(tree.count())]
+        self.assertEqual(spuns, ['Result: a d', 'Result: a e', 'Result: a f',
+                                 'Result: b d', 'Result: b e', 'Result: b f',
+                                 'Result: c d', 'Result: c e', 'Result: c f'])
+        for i, spun in enumerate(spuns):
+            self.assertEqual(tree.rank(spun), i)
+        
+        self.assertRaises(IndexError, tree.unrank, 9)
+        self.assertRaises(ValueError, tree.rank, 'Result: a')
+        
+        tree = Spin(' '.join(['{a|b|c|{d|e}}'] * 60)).build_tree()
+        index = tree.count() // 3
+        self.assertEqual(tree.rank(tree.unrank(index)), index)
+    
+    def test_diversity_report(self):
+        report = Spin('Result: {a|{b|c}} {{d|e}|f}').diversity_report(n=10)
+        self.assertEqual(report['count'], 9)
+        self.assertAlmostEqual(report['expected_tokens'], 3)
+        self.assertAlmostEqual(report['collision_probability'], 0.375 ** 2)
+        self.assertAlmostEqual(report['expected_collisions'], 45 * 0.375 ** 2)
+        self.assertAlmostEqual(report['expected_jaccard'], 1.75 / 4.25)
+        self.assertEqual([node['branches'] for node in report['or_nodes']], [2, 2, 2, 2])
+        self.assertEqual([node['reach'] for node in report['or_nodes']], [1, 0.5, 1, 0.5])
+        
+        # A deep chain of '{w x <chain>|y}' groups, in linear time
+        tree = SpinTree(value='end')
+        for i in range(3000):
+            branch = SpinTree(and_=True)
+            branch.add_child(SpinTree(value='w%d x ' % i))
+            branch.add_child(tree)
+            tree = SpinTree(or_=True)
+            tree.add_child(branch)
+            tree.add_child(SpinTree(value='y'))
+        report = diversity_report(tree)
+        self.assertAlmostEqual(report['expected_tokens'], 3)
+        self.assertEqual(len(report['or_nodes']), 3000)
+        self.assertAlmostEqual(report['collision_probability'], 1 / 3)
+    
+    def test_iter_all(self):
+        tree = Spin('Result: {a|{b|c}} {{d|e}|f}').build_tree()
+        spuns = [tree.unrank(i) for i in range(tree.count())]
+        self.assertEqual(list(tree.iter_all()), spuns)
+        self.assertEqual(list(tree.iter_all(2, 7)), spuns[2:7])
+        self.assertEqual(list(tree.iter_all(8, 100)), spuns[8:])
+        self.assertEqual(list(tree.iter_all(9)), [])
+        
+        tree = Spin(' '.join(['{a|b|c|{d|e}}'] * 60)).build_tree()
+        start = tree.count() - 10
+        self.assertEqual(list(tree.iter_all(start)),
+                         [tree.unrank(i) for i in range(start, tree.count())])
+        self.assertEqual(list(islice(tree.iter_all(), 10)), [tree.unrank(i) for i in range(10)])
+        self.assertEqual(list(islice(Spin('{a|b} ' * 63).enumerate(), 2)),
+                         ['a ' * 62 + 'a', 'a ' * 62 + 'b'])
+    
+    def test_streaming_export(self):
+        tree = Spin("{My name is|I{ am|'m}} John Doe{.|!}").build_tree()
+        fp = io.StringIO()
+        tree.dump_json(fp, buffer_size=2)
+        self.assertEqual(fp.getvalue(), tree.to_json())
+        fp = io.StringIO()
+        tree.write_text(fp)
+        self.assertEqual(fp.getvalue(), str(tree))
+        self.assertEqual(str(tree), "AND\n__OR\n____My name is\n____AND\n______I\n______OR\n"
+                                    "________ am\n________'m\n__ John Doe\n__OR\n____.\n____!")
+    
+    def test_deep_nesting(self):
+        masterspin = 'x'
+        for _ in range(3000):
+            masterspin = '{a|b ' + masterspin + ' c}'
+        tree = Spin(masterspin).build_tree()
+        self.assertEqual(tree.count(), 3001)
+        self.assertEqual(SpinTree.from_bytes(tree.to_bytes()).to_json(), tree.to_json())
+        self.assertEqual(SpinTree.from_dict(tree.to_dict()).to_json(), tree.to_json())
+        self.assertEqual(tree.unrank(3000), 'b ' * 3000 + 'x' + ' c' * 3000)
+    
+    def test_compact_nodes(self):
+        tree = SpinTree(and_=True)
+        tree.add_child(SpinTree(value='a'))
+        tree.add_child(SpinTree(value='b'))
+        choice = SpinTree(or_=True)
+        choice.add_child(SpinTree(value='c'))
+        choice.add_child(SpinTree(value='d'))
+        tree.add_child(choice)
+        tree.add_child(SpinTree(value='e'))
+        self.assertEqual(tree.to_json(),
+                         '{"and": [{"value": "ab"}, {"or": [{"value": "c"}, {"value": "d"}]}, {"value": "e"}]}')
+        self.assertTrue(tree.and_)
+        self.assertFalse(tree.or_)
+        self.assertEqual(tree.children[0].children, ())
+        self.assertRaises(AttributeError, setattr, tree, 'other', 1)
+    
+    def test_serialization(self):
+        tree = Spin("{My name is|I{ am|'m}} John Doe and I {truly|really} love the {spintax|spin framework}{.|!}").build_tree()
+        self.assertEqual(SpinTree.from_json(tree.to_json()).to_json(), tree.to_json())
+        self.assertEqual(SpinTree.from_bytes(tree.to_bytes()).to_json(), tree.to_json())
+        
+        tree = Spin('Café {crème|au lait|}').build_tree()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tree.spt')
+            tree.save(path)
+            self.assertEqual(SpinTree.load(path).to_json(), tree.to_json())
+    
+    def test_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            masterspin = 'Result: {a|{b|c}} {{d|e}|f}'
+            tree = Spin(masterspin, cache_dir=cache_dir).build_tree()
+            spuns = Spin(masterspin, cache_dir=cache_dir).unspin_many(20, seed=1)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            
+            spin = Spin(masterspin, cache_dir=cache_dir)
+            self.assertEqual(spin.build_tree().to_json(), tree.to_json())
+            self.assertEqual(spin.unspin_many(20, seed=1), spuns)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            
+            program = Spin('a {b|{c|d} e|} f{g|}', cache_dir=cache_dir).compile()
+            loaded = SpinProgram.from_bytes(program.to_bytes())
+            self.assertEqual(loaded.texts, program.texts)
+            self.assertEqual(loaded.parents, program.parents)
+            self.assertEqual(loaded.choices, program.choices)
+            self.assertEqual(loaded.texts, SpinProgram(loaded.ops, loaded.choices).texts)
+    
+    def test_damaged_cache(self):
+        masterspin = 'Result: {a|{b|c}} {{d|e}|f}'
+        spuns = Spin(masterspin).unspin_many(20, seed=1)
+        tree = Spin(masterspin).build_tree().to_json()
+        truncations = [lambda data: data[:10], lambda data: data[:40], lambda data: data[:-1]]
+        for damage in truncations + [lambda data: data[:-2] + b'\xff\xff']:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                Spin(masterspin, cache_dir=cache_dir).build_tree()
+                Spin(masterspin, cache_dir=cache_dir).compile()
+                for name in os.listdir(cache_dir):
+                    path = os.path.join(cache_dir, name)
+                    with open(path, 'rb') as f:
+                        data = damage(f.read())
+                    with open(path, 'wb') as f:
+                        f.write(data)
+                    if damage in truncations:
+                        cls = SpinTree if name.endswith('.spt') else SpinProgram
+                        self.assertRaises(ValueError, cls.from_bytes, data)
+                # The damaged files are built again
+                spin = Spin(masterspin, cache_dir=cache_dir)
+                self.assertEqual(spin.unspin_many(20, seed=1), spuns)
+                self.assertEqual(spin.build_tree().to_json(), tree)
+                self.assertEqual(Spin(masterspin, cache_dir=cache_dir).unspin_many(20, seed=1), spuns)
+    
+    def test_rank_ambiguous(self):
+        tree = Spin('{a|ab}{b|}').build_tree()
+        self.assertEqual(tree.rank('ab'), 0)
+        
+        tree = Spin('{a|ab|}{b|bb|}{c|}x').build_tree()
+        lowest = {}
+        for index, spun in enumerate(tree.iter_all()):
+            lowest.setdefault(spun, index)
+        for spun, index in lowest.items():
+            self.assertEqual(tree.rank(spun), index)
+    
+    def test_rank_large(self):
+        tree = Spin(' '.join(['{a|b}'] * 500)).build_tree()
+        self.assertEqual(tree.rank(tree.unrank(12345)), 12345)
+        
+        # Not generable: every combination of the groups used to be tried
+        tree = Spin('{a|}' * 200).build_tree()
+        self.assertRaises(ValueError, tree.rank, 'a' * 201)
+        
+        tree = Spin(' {a|b} ').build_tree()
+        self.assertEqual(tree.rank(' b '), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()